@@ -2,7 +2,7 @@ import utilities as util
 
 
 # Main analysis
-def main():
+def main(workers=None):
     print("---------------------------")
     print("Polygenic epicenter mapping")
     print("---------------------------")
@@ -14,17 +14,17 @@ def main():
     print("Functional networks")
     print("---------------------------")
     # Cortical epicenters
-    fc_ctx_r, fc_ctx_p = util.epicenter_mapping(prs_map, fc_ctx)
+    fc_ctx_r, fc_ctx_p = util.epicenter_mapping(prs_map, fc_ctx, workers=workers)
     # Subcortical epicenters
-    fc_sctx_r, fc_sctx_p = util.epicenter_mapping(prs_map, fc_sctx)
+    fc_sctx_r, fc_sctx_p = util.epicenter_mapping(prs_map, fc_sctx, workers=workers)
 
     print()
     print("Structural networks")
     print("---------------------------")
     # Cortical epicenters
-    sc_ctx_r, sc_ctx_p = util.epicenter_mapping(prs_map, sc_ctx)
+    sc_ctx_r, sc_ctx_p = util.epicenter_mapping(prs_map, sc_ctx, workers=workers)
     # Subcortical epicenters
-    sc_sctx_r, sc_sctx_p = util.epicenter_mapping(prs_map, sc_sctx)
+    sc_sctx_r, sc_sctx_p = util.epicenter_mapping(prs_map, sc_sctx, workers=workers)
 
     print()
     print("Save results")
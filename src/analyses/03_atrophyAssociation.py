@@ -11,7 +11,7 @@ def load_local_tle():
     numpy.ndarray: The loaded data containing age, sex, dataset, focus, and ct information.
     """
     return util.load_data(
-        "../../data/processed/local_tle_data.npz",
+        "../../data/processed/local_tle_data",
         ["age", "sex", "focus", "ct"],
     )
 
@@ -24,13 +24,13 @@ def load_multi_tle():
     numpy.ndarray: The loaded data containing age, sex, dataset, group, focus, and ct information.
     """
     return util.load_data(
-        "../../data/processed/multi_tle_data.npz",
+        "../../data/processed/multi_tle_data",
         ["age", "sex", "focus", "ct"],
     )
 
 
 # Main analysis
-def main():
+def main(workers=None):
     load_dataset = {"local": load_local_tle, "multi": load_multi_tle}
     for key in load_dataset:
         
@@ -62,7 +62,9 @@ def main():
             print()
             print("Correlate with PRS map")
             print("------------------------")
-            r, p, null = util.spatial_correlation(slm.t, imaging_genetics.t)
+            r, p, null = util.spatial_correlation(
+                slm.t, imaging_genetics.t, workers=workers
+            )
 
             association[f"{hemi.lower()}tle"] = {"r": r, "p": p, "null": null}
 
@@ -77,6 +79,10 @@ def main():
             {"atrophy": atrophy},
         )
 
+        association = util.compact_nulls(
+            f"../../data/results/03_atrophyAssociation/{key}_association_nulls.npz",
+            association,
+        )
         util.save_to_pickle(
             f"../../data/results/03_atrophyAssociation/{key}_association.pkl",
             {"association": association},
@@ -3,7 +3,7 @@ import utilities as util
 
 
 # Main analysis
-def main():
+def main(workers=None):
     fc_ctx, fc_sctx, sc_ctx, sc_sctx = util.load_connectomes()
     prs_fc_ctx, prs_fc_sctx, prs_sc_ctx, prs_sc_sctx = util.load_imaging_genetic(
         "network"
@@ -19,9 +19,25 @@ def main():
             f"../../data/results/03_atrophyAssociation/{site}_atrophy.pkl", ["atrophy"]
         )[0]
 
+        # Derive disease epicentre maps of both hemispheres in one pass
+        hemis = ["L", "R"]
+        atrophy_maps = np.vstack([atrophy[f"{hemi.lower()}tle"].t for hemi in hemis])
+        fc_ctx_r_all, fc_ctx_p_all = util.epicenter_mapping(
+            atrophy_maps, fc_ctx, workers=workers
+        )
+        fc_sctx_r_all, fc_sctx_p_all = util.epicenter_mapping(
+            atrophy_maps, fc_sctx, workers=workers
+        )
+        sc_ctx_r_all, sc_ctx_p_all = util.epicenter_mapping(
+            atrophy_maps, sc_ctx, workers=workers
+        )
+        sc_sctx_r_all, sc_sctx_p_all = util.epicenter_mapping(
+            atrophy_maps, sc_sctx, workers=workers
+        )
+
         epicentre = {}
         association = {}
-        for hemi in ["L", "R"]:
+        for h, hemi in enumerate(hemis):
             print()
             print("------------------------")
             print(f"{hemi} temporal lobe epilepsy")
@@ -30,11 +46,10 @@ def main():
             print()
             print("Derive disease epicentre map")
             print("------------------------")
-            atrophy_map = atrophy[f"{hemi.lower()}tle"].t
-            fc_ctx_r, fc_ctx_p = util.epicenter_mapping(atrophy_map, fc_ctx)
-            fc_sctx_r, fc_sctx_p = util.epicenter_mapping(atrophy_map, fc_sctx)
-            sc_ctx_r, sc_ctx_p = util.epicenter_mapping(atrophy_map, sc_ctx)
-            sc_sctx_r, sc_sctx_p = util.epicenter_mapping(atrophy_map, sc_sctx)
+            fc_ctx_r, fc_ctx_p = fc_ctx_r_all[h], fc_ctx_p_all[h]
+            fc_sctx_r, fc_sctx_p = fc_sctx_r_all[h], fc_sctx_p_all[h]
+            sc_ctx_r, sc_ctx_p = sc_ctx_r_all[h], sc_ctx_p_all[h]
+            sc_sctx_r, sc_sctx_p = sc_sctx_r_all[h], sc_sctx_p_all[h]
             epicentre[f"{hemi.lower()}tle"] = {
                 "fc_ctx": {"r": fc_ctx_r, "p": fc_ctx_p},
                 "fc_sctx": {"r": fc_ctx_r, "p": fc_sctx_p},
@@ -50,12 +65,14 @@ def main():
                 np.concatenate((prs_fc_ctx, prs_fc_sctx)),
                 surface_name="fsa5_with_sctx",
                 parcellation_name="aparc_aseg",
+                workers=workers,
             )
             r_sc_epi, p_sc_epi, null_sc_epi = util.spatial_correlation(
                 np.concatenate((sc_ctx_r, sc_sctx_r)),
                 np.concatenate((prs_sc_ctx, prs_sc_sctx)),
                 surface_name="fsa5_with_sctx",
                 parcellation_name="aparc_aseg",
+                workers=workers,
             )
 
             association[f"{hemi.lower()}tle"] = {
@@ -83,6 +100,10 @@ def main():
             {"epicentre": epicentre},
         )
 
+        association = util.compact_nulls(
+            f"../../data/results/04_epicentreAssociation/{site}_association_nulls.npz",
+            association,
+        )
         util.save_to_pickle(
             f"../../data/results/04_epicentreAssociation/{site}_association.pkl",
             {"association": association},
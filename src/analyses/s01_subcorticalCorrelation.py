@@ -2,8 +2,6 @@ import numpy as np
 import pandas as pd
 import utilities as util
 from brainstat.stats.terms import FixedEffect
-from brainstat.stats.SLM import SLM
-from scipy.stats import pearsonr
 
 
 # Helper functions
@@ -15,13 +13,13 @@ def load_abcd():
     numpy.ndarray: The loaded data containing age, sex, site, PC10, threshold, prs, and sv information.
     """
     return util.load_data(
-        "../../data/processed/abcd_data.npz",
+        "../../data/processed/abcd_data",
         ["age", "sex", "site", "pc10", "thresh", "prs_all", "sv", "icv"],
     )
 
 
 # Main analysis
-def main():
+def main(workers=None):
     # Load data
     age, sex, site, pc10, thresh, prs_all, sv, icv = load_abcd()
 
@@ -41,10 +39,7 @@ def main():
     term_pc10 = FixedEffect(pc10, [f"PC{i}" for i in range(10)])
     term_icv = FixedEffect(icv, "ICV")
     model = term_age + term_sex + term_pc10 + term_icv
-    contrast = np.ones(len(prs))
-    slm = SLM(model, contrast)
-    slm.fit(sv)
-    residual = sv - np.dot(slm.X, slm.coef)
+    residual = util.residualize(sv, model.m)
 
     n_sctx = sv.shape[1]
     # Lobe indices
@@ -69,23 +64,35 @@ def main():
 
     # Correlate with PRS-TLE
     mean_sv = np.zeros((len(prs), len(subcortical)))
-    r = np.zeros(len(subcortical))
-    r2 = np.zeros(len(subcortical))
-    p = np.zeros(len(subcortical))
-
     for i, sctx in enumerate(subcortical):
         idx = subcortical[sctx]
         mean_sv[:, i] = (
             np.sum(residual[:, idx], axis=1) if "whole" in sctx else residual[:, idx]
         )
-        corr = pearsonr(prs, mean_sv[:, i])
-        r[i], r2[i], p[i] = corr.statistic, corr.statistic**2, corr.pvalue
+    r, r2, p, ci = (stat[0] for stat in util.pearson(prs, mean_sv))
+
+    for i, sctx in enumerate(subcortical):
         print(f"{sctx}: r = {r[i]}, r-squared = {r2[i]}, p = {p[i]}")
 
     global_association = pd.DataFrame(
-        {"subcortical": subcortical.keys(), "r": r, "r2": r2, "p": p}
+        {
+            "subcortical": subcortical.keys(),
+            "r": r,
+            "r2": r2,
+            "p": p,
+            "ci_low": ci[:, 0],
+            "ci_high": ci[:, 1],
+        }
     )
 
+    # Bootstrap confidence intervals, enabled by PRS_TLE_N_BOOT
+    n_boot = int(util.config("n_boot", 0))
+    if n_boot > 0:
+        print(f"Bootstrap resamples: {n_boot}")
+        boot_ci = util.bootstrap_pearson(prs, mean_sv, n_boot=n_boot, workers=workers)
+        global_association["boot_ci_low"] = boot_ci[0, :, 0]
+        global_association["boot_ci_high"] = boot_ci[0, :, 1]
+
     print()
     print("Save results")
     print("-----------------------------")
@@ -93,3 +100,7 @@ def main():
         "../../data/results/s01_subcorticalCorrelation/global_association.pkl",
         {"global_association": global_association, "mean_sv": mean_sv, "prs": prs},
     )
+
+
+if __name__ == "__main__":
+    main()
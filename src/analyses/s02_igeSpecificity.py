@@ -12,13 +12,13 @@ def load_multi_ige():
     numpy.ndarray: The loaded data containing age, sex, dataset, group, focus, and ct information.
     """
     return util.load_data(
-        "../../data/processed/multi_ige_data.npz",
+        "../../data/processed/multi_ige_data",
         ["age", "sex", "group", "ct"],
     )
 
 
 # Main analysis
-def main():
+def main(workers=None):
     print()
     print("--------------------")
     print("Case-control atrophy")
@@ -43,7 +43,7 @@ def main():
     print()
     print("Correlate with PRS map")
     print("--------------------")
-    r, p, null = util.spatial_correlation(slm.t, imaging_genetics.t)
+    r, p, null = util.spatial_correlation(slm.t, imaging_genetics.t, workers=workers)
 
     atrophy_association["ige"] = {"r": r, "p": p, "null": null}
 
@@ -57,6 +57,10 @@ def main():
         {"atrophy": atrophy},
     )
 
+    atrophy_association = util.compact_nulls(
+        "../../data/results/s02_igeSpecificity/ige_atrophyAssociation_nulls.npz",
+        atrophy_association,
+    )
     util.save_to_pickle(
         "../../data/results/s02_igeSpecificity/ige_atrophyAssociation.pkl",
         {"association": atrophy_association},
@@ -80,10 +84,10 @@ def main():
     print("Derive disease epicentre")
     print("---------------------------")
     atrophy_map = atrophy["ige"].t
-    fc_ctx_r, fc_ctx_p = util.epicenter_mapping(atrophy_map, fc_ctx)
-    fc_sctx_r, fc_sctx_p = util.epicenter_mapping(atrophy_map, fc_sctx)
-    sc_ctx_r, sc_ctx_p = util.epicenter_mapping(atrophy_map, sc_ctx)
-    sc_sctx_r, sc_sctx_p = util.epicenter_mapping(atrophy_map, sc_sctx)
+    fc_ctx_r, fc_ctx_p = util.epicenter_mapping(atrophy_map, fc_ctx, workers=workers)
+    fc_sctx_r, fc_sctx_p = util.epicenter_mapping(atrophy_map, fc_sctx, workers=workers)
+    sc_ctx_r, sc_ctx_p = util.epicenter_mapping(atrophy_map, sc_ctx, workers=workers)
+    sc_sctx_r, sc_sctx_p = util.epicenter_mapping(atrophy_map, sc_sctx, workers=workers)
     epicentre["ige"] = {
         "fc_ctx": {"r": fc_ctx_r, "p": fc_ctx_p},
         "fc_sctx": {"r": fc_ctx_r, "p": fc_ctx_p},
@@ -100,6 +104,7 @@ def main():
         surface_name="fsa5_with_sctx",
         parcellation_name="aparc_aseg",
         n_rot=5000,
+        workers=workers,
     )
 
     r_sc_epi, p_sc_epi, null_sc_epi = util.spatial_correlation(
@@ -108,6 +113,7 @@ def main():
         surface_name="fsa5_with_sctx",
         parcellation_name="aparc_aseg",
         n_rot=5000,
+        workers=workers,
     )
 
     network_association["ige"] = {
@@ -131,6 +137,10 @@ def main():
         {"epicentre": epicentre},
     )
 
+    network_association = util.compact_nulls(
+        "../../data/results/s02_igeSpecificity/ige_epicentreAssociation_nulls.npz",
+        network_association,
+    )
     util.save_to_pickle(
         "../../data/results/s02_igeSpecificity/ige_epicentreAssociation.pkl",
         {"association": network_association},
@@ -31,7 +31,7 @@ def load_psychiatry():
 
 
 # Main analysis
-def main():
+def main(workers=None):
     # Load atrophy from ENIGMA
     atrophy = load_psychiatry()
 
@@ -42,11 +42,17 @@ def main():
     print("----------------------")
     print("Correlate with PRS map")
     print("----------------------")
-    for psy in atrophy:
+    r_all, p_all, null_all = util.spatial_correlation_matrix(
+        np.vstack([atrophy[psy] for psy in atrophy]),
+        imaging_genetics,
+        return_null=True,
+        workers=workers,
+    )
+    for i, psy in enumerate(atrophy):
         print()
         print(f"{psy}")
         print("----------------------")
-        r, p, null = util.spatial_correlation(atrophy[psy], imaging_genetics)
+        r, p, null = r_all[i, 0], p_all[i, 0], null_all[i, 0]
 
         association[psy] = {"r": r, "p": p, "null": null}
 
@@ -61,6 +67,10 @@ def main():
         {"atrophy": atrophy},
     )
 
+    association = util.compact_nulls(
+        "../../data/results/s03_psychiatryAtrophySpecificity/psychiatric_association_nulls.npz",
+        association,
+    )
     util.save_to_pickle(
         "../../data/results/s03_psychiatryAtrophySpecificity/psychiatric_association.pkl",
         {"association": association},
@@ -3,7 +3,7 @@ import utilities as util
 
 
 # Main analysis
-def main():
+def main(workers=None):
     # Load atrophy from ENIGMA
     atrophy = util.load_result(
         "../../data/results/s03_psychiatryAtrophySpecificity/psychiatric_atrophy.pkl",
@@ -21,8 +21,23 @@ def main():
     prs_fc_epi = np.concatenate((prs_fc_ctx, prs_fc_sctx))
     prs_sc_epi = np.concatenate((prs_sc_ctx, prs_sc_sctx))
 
+    # Derive epicentre maps of all disorders in one pass
+    atrophy_maps = np.vstack([atrophy[psy] for psy in atrophy])
+    fc_ctx_r_all, fc_ctx_p_all = util.epicenter_mapping(
+        atrophy_maps, fc_ctx, workers=workers
+    )
+    fc_sctx_r_all, fc_sctx_p_all = util.epicenter_mapping(
+        atrophy_maps, fc_sctx, workers=workers
+    )
+    sc_ctx_r_all, sc_ctx_p_all = util.epicenter_mapping(
+        atrophy_maps, sc_ctx, workers=workers
+    )
+    sc_sctx_r_all, sc_sctx_p_all = util.epicenter_mapping(
+        atrophy_maps, sc_sctx, workers=workers
+    )
+
     epicentre, association = {}, {}
-    for psy in atrophy:
+    for i, psy in enumerate(atrophy):
         print("------------------------------")
         print(psy.upper())
         print("------------------------------")
@@ -30,11 +45,10 @@ def main():
         print()
         print("Derive epicentre map")
         print("------------------------------")
-        atrophy_map = atrophy[psy]
-        fc_ctx_r, fc_ctx_p = util.epicenter_mapping(atrophy_map, fc_ctx)
-        fc_sctx_r, fc_sctx_p = util.epicenter_mapping(atrophy_map, fc_sctx)
-        sc_ctx_r, sc_ctx_p = util.epicenter_mapping(atrophy_map, sc_ctx)
-        sc_sctx_r, sc_sctx_p = util.epicenter_mapping(atrophy_map, sc_sctx)
+        fc_ctx_r, fc_ctx_p = fc_ctx_r_all[i], fc_ctx_p_all[i]
+        fc_sctx_r, fc_sctx_p = fc_sctx_r_all[i], fc_sctx_p_all[i]
+        sc_ctx_r, sc_ctx_p = sc_ctx_r_all[i], sc_ctx_p_all[i]
+        sc_sctx_r, sc_sctx_p = sc_sctx_r_all[i], sc_sctx_p_all[i]
         epicentre[psy] = {
             "fc_ctx": {"r": fc_ctx_r, "p": fc_ctx_p},
             "fc_sctx": {"r": fc_ctx_r, "p": fc_sctx_p},
@@ -51,6 +65,7 @@ def main():
             surface_name="fsa5_with_sctx",
             parcellation_name="aparc_aseg",
             n_rot=5000,
+            workers=workers,
         )
 
         r_sc_epi, p_sc_epi, null_sc_epi = util.spatial_correlation(
@@ -59,6 +74,7 @@ def main():
             surface_name="fsa5_with_sctx",
             parcellation_name="aparc_aseg",
             n_rot=5000,
+            workers=workers,
         )
 
         association[psy] = {
@@ -86,6 +102,10 @@ def main():
         {"epicentre": epicentre},
     )
 
+    association = util.compact_nulls(
+        "../../data/results/s04_psychiatryEpicentreSpecificity/psychiatric_association_nulls.npz",
+        association,
+    )
     util.save_to_pickle(
         "../../data/results/s04_psychiatryEpicentreSpecificity/psychiatric_association.pkl",
         {"association": association},
@@ -2,9 +2,6 @@ import numpy as np
 import pandas as pd
 import utilities as util
 from brainstat.stats.terms import FixedEffect
-from brainstat.stats.SLM import SLM
-from enigmatoolbox.utils import parcel_to_surface
-from scipy.stats import pearsonr
 
 
 # Helper functions
@@ -16,7 +13,7 @@ def load_abcd():
     numpy.ndarray: The loaded data containing age, sex, site, PC10, threshold, prs, and ct information.
     """
     return util.load_data(
-        "../../data/processed/abcd_data.npz",
+        "../../data/processed/abcd_data",
         ["age", "sex", "site", "pc10", "thresh", "prs_all", "ct_vertex", "ct_aparc"],
     )
 
@@ -29,7 +26,7 @@ def load_multi_tle():
     numpy.ndarray: The loaded data containing age, sex, dataset, group, focus, and ct information.
     """
     return util.load_data(
-        "../../data/processed/multi_tle_data.npz",
+        "../../data/processed/multi_tle_data",
         ["age", "sex", "focus", "ct"],
     )
     
@@ -42,14 +39,14 @@ def load_multi_ige():
     numpy.ndarray: The loaded data containing age, sex, dataset, group, focus, and ct information.
     """
     return util.load_data(
-        "../../data/processed/multi_ige_data.npz",
+        "../../data/processed/multi_ige_data",
         ["age", "sex", "group", "ct"],
     )
 
 
 
 # Main analysis
-def main():
+def main(workers=None):
     # Load data
     age, sex, site, pc10, thresh, prs_all, ct_vertex, ct_aparc = load_abcd()
 
@@ -57,15 +54,7 @@ def main():
     print("Effects of PRS across different thresholds")
     print("------------------------------------------")
 
-    thresholds = [
-        "Pt_0.00100005",
-        "Pt_0.0500001",
-        "Pt_0.1",
-        "Pt_0.2",
-        "Pt_0.3",
-        "Pt_0.4",
-        "Pt_0.5",
-    ]
+    thresholds = util.PRS_THRESHOLDS
 
     print("-----------------------------")
     print("Brain-wide effects of PRS-TLE")
@@ -79,45 +68,34 @@ def main():
     term_sex = FixedEffect(sex, "Sex")
     term_pc10 = FixedEffect(pc10, [f"PC{i}" for i in range(10)])
     model = term_age + term_sex + term_pc10
-    contrast = np.ones(prs_all.shape[0])
-    slm = SLM(model, contrast)
-    slm.fit(ct_vertex)
-    residual = ct_vertex - np.dot(slm.X, slm.coef)
-
-    # Lobe indices
-    lobe_names = ["whole", "frontal", "limbic", "occipital", "parietal", "temporal"]
-    frontal = [17, 18, 25, 16, 22, 2, 26, 10, 12, 30, 15, 46, 64, 60, 49, 44, 59, 52, 50, 56, 36, 51,]
-    limbic = [8, 21, 1, 24, 33, 58, 35, 55, 42, 67]
-    occipital = [11, 19, 9, 3, 45, 53, 37, 43]
-    parietal = [20, 27, 29, 6, 23, 54, 61, 40, 63, 57]
-    temporal = [4, 5, 7, 13, 14, 28, 31, 32, 0, 41, 47, 62, 38, 65, 48, 39, 66, 34]
-    lobes = np.zeros(68)
-    lobes[frontal] = 1
-    lobes[limbic] = 2
-    lobes[occipital] = 3
-    lobes[parietal] = 4
-    lobes[temporal] = 5
-    lobes = parcel_to_surface(lobes, "aparc_conte69")
+    residual = util.residualize(ct_vertex, model.m)
+
+    # Lobe parcels
+    lobes = {
+        "whole": "all",
+        "frontal": [17, 18, 25, 16, 22, 2, 26, 10, 12, 30, 15, 46, 64, 60, 49, 44, 59, 52, 50, 56, 36, 51,],
+        "limbic": [8, 21, 1, 24, 33, 58, 35, 55, 42, 67],
+        "occipital": [11, 19, 9, 3, 45, 53, 37, 43],
+        "parietal": [20, 27, 29, 6, 23, 54, 61, 40, 63, 57],
+        "temporal": [4, 5, 7, 13, 14, 28, 31, 32, 0, 41, 47, 62, 38, 65, 48, 39, 66, 34],
+    }
+    lobe_names = list(lobes)
+    lobe_ct = np.asarray(residual @ util.surface_averaging_matrix(lobes))
 
     # Correlate with PRS-TLE
+    prs_thr = np.hstack([prs_all[:, thresh == thr] for thr in thresholds])
+    r, r2, p, ci = util.pearson(prs_thr, lobe_ct)
     global_association = {}
     for i, lobe in enumerate(lobe_names):
-        if "whole" in lobe:
-            idx = np.array([True] * len(lobes))
-        else:
-            idx = lobes == i
-
-        r = np.zeros(len(thresholds))
-        r2 = np.zeros(len(thresholds))
-        p = np.zeros(len(thresholds))
-        mean_ct = np.mean(residual[:, idx], axis=1)
-        for thr in thresholds:
-            prs = prs_all[:, thresh == thr].flatten()
-            corr = pearsonr(prs, mean_ct)
-            r[i], r2[i], p[i] = corr.statistic, corr.statistic**2, corr.pvalue
-
         global_association[lobe] = pd.DataFrame(
-            {"thresholds": thresholds, "r": r, "r2": r2, "p": p}
+            {
+                "thresholds": thresholds,
+                "r": r[:, i],
+                "r2": r2[:, i],
+                "p": p[:, i],
+                "ci_low": ci[:, i, 0],
+                "ci_high": ci[:, i, 1],
+            }
         )
 
         print(f"{lobe} lobe done")
@@ -125,17 +103,20 @@ def main():
     print()
     print("Regional effects across thresholds")
     print("------------------------------------------")
-    regional_association = {}
-    for thr in thresholds:
-        prs = prs_all[:, thresh == thr]
-        term_prs = FixedEffect(prs)
-        model = term_age + term_sex + term_pc10 + term_prs
-        contrast = prs
-        slm = SLM(model, contrast, correction="fdr", two_tailed=True)
-        slm.fit(ct_aparc)
-        regional_association[thr] = slm
-
-        print(f"{thr} done")
+    # Fit all thresholds at once on the shared age, sex, and PC10 design, from sufficient
+    # statistics that PRS_TLE_INCREMENTAL updates with appended participants only
+    model = term_age + term_sex + term_pc10
+    regional_association = dict(
+        zip(
+            thresholds,
+            util.accumulate_glm(
+                "../../data/results/s05_thresholdConsistency/threshold_regional_statistics.pkl",
+                ct_aparc,
+                model.m,
+                prs_thr,
+            ),
+        )
+    )
 
     print()
     print("Save results")
@@ -158,16 +139,13 @@ def main():
     print()
     print("Psnp thresholds - regional")
     print("----------------------------------")
-    thr_similarity_r = np.zeros((len(thresholds), len(thresholds)))
-    thr_similarity_p = np.zeros((len(thresholds), len(thresholds)))
-    for i in range(len(thresholds)):
-        thr1 = regional_association[thresholds[i]]
-        for j in range(i, len(thresholds)):
-            thr2 = regional_association[thresholds[j]]
-            thr_similarity_r[i, j], thr_similarity_p[i, j], _ = (
-                util.spatial_correlation(thr1.t, thr2.t, n_rot=5000)
-            )
-            print(f"{thresholds[i]} x {thresholds[j]} done")
+    thr_maps = np.vstack([regional_association[thr].t for thr in thresholds])
+    thr_similarity_r, thr_similarity_p = util.spatial_correlation_matrix(
+        thr_maps, thr_maps, n_rot=5000, workers=workers
+    )
+    # Only the upper triangle of the threshold pairs is reported
+    thr_similarity_r = np.triu(thr_similarity_r)
+    thr_similarity_p = np.triu(thr_similarity_p)
 
     print()
     print("Comparison to case-control atrophy")
@@ -186,14 +164,12 @@ def main():
     )[0]
     epilepsy_atrophy["ige"] = multi_ige_atrophy["ige"]
     
-    atrophy_similarity_r = np.zeros((len(thresholds), len(epilepsy_atrophy)))
-    atrophy_similarity_p = np.zeros((len(thresholds), len(epilepsy_atrophy)))
-    for i in range(len(thresholds)):
-        map1 = regional_association[thresholds[i]]
-        for j, subtype in enumerate(epilepsy_atrophy):
-            map2 = epilepsy_atrophy[subtype]
-            atrophy_similarity_r[i, j], atrophy_similarity_p[i, j], _ = util.spatial_correlation(map1.t, map2.t, n_rot=5000)
-
+    atrophy_maps = np.vstack(
+        [epilepsy_atrophy[subtype].t for subtype in epilepsy_atrophy]
+    )
+    atrophy_similarity_r, atrophy_similarity_p = util.spatial_correlation_matrix(
+        thr_maps, atrophy_maps, n_rot=5000, workers=workers
+    )
 
     print()
     print("Save results")
@@ -3,20 +3,12 @@ import utilities as util
 
 
 # Main analysis
-def main():
+def main(workers=None):
     print("------------------------------------------")
     print("Effects of PRS across different thresholds")
     print("------------------------------------------")
 
-    thresholds = [
-        "Pt_0.00100005",
-        "Pt_0.0500001",
-        "Pt_0.1",
-        "Pt_0.2",
-        "Pt_0.3",
-        "Pt_0.4",
-        "Pt_0.5",
-    ]
+    thresholds = util.PRS_THRESHOLDS
 
     regional_association = util.load_result(
         "../../data/results/s05_thresholdConsistency/threshold_regional_association.pkl",
@@ -25,63 +17,41 @@ def main():
 
     fc_ctx, fc_sctx, sc_ctx, sc_sctx = util.load_connectomes()
 
-    thr_fc_epicentre = np.zeros((len(thresholds), 82))
-    thr_sc_epicentre = np.zeros((len(thresholds), 82))
-    fc_epicentre_similarity_r = np.zeros((len(thresholds), len(thresholds)))
-    fc_epicentre_similarity_p = np.zeros((len(thresholds), len(thresholds)))
-    sc_epicentre_similarity_r = np.zeros((len(thresholds), len(thresholds)))
-    sc_epicentre_similarity_p = np.zeros((len(thresholds), len(thresholds)))
-
-    percent_fc_ctx = np.zeros((len(thresholds), 68))
-    percent_fc_sctx = np.zeros((len(thresholds), 14))
-    percent_sc_ctx = np.zeros((len(thresholds), 68))
-    percent_sc_sctx = np.zeros((len(thresholds), 14))
-
-    for i in range(len(thresholds)):
-        thr1 = regional_association[thresholds[i]].t
-
-        fc_ctx_r1, fc_ctx_p1 = util.epicenter_mapping(thr1, fc_ctx)
-        fc_sctx_r1, fc_sctx_p1 = util.epicenter_mapping(thr1, fc_sctx)
-        sc_ctx_r1, sc_ctx_p1 = util.epicenter_mapping(thr1, sc_ctx)
-        sc_sctx_r1, sc_sctx_p1 = util.epicenter_mapping(thr1, sc_sctx)
-
-        thr_fc_epicentre[i, :] = np.concatenate((fc_ctx_r1, fc_sctx_r1))
-        thr_sc_epicentre[i, :] = np.concatenate((sc_ctx_r1, sc_sctx_r1))
-
-        percent_fc_ctx[i, :] = fc_ctx_p1 < 0.05
-        percent_fc_sctx[i, :] = fc_sctx_p1 < 0.05
-        percent_sc_ctx[i, :] = sc_ctx_p1 < 0.05
-        percent_sc_sctx[i, :] = sc_sctx_p1 < 0.05
-
-        for j in range(i, len(thresholds)):
-            thr2 = regional_association[thresholds[j]].t
-
-            fc_ctx_r2, _ = util.epicenter_mapping(thr2, fc_ctx)
-            fc_sctx_r2, _ = util.epicenter_mapping(thr2, fc_sctx)
-            sc_ctx_r2, _ = util.epicenter_mapping(thr2, sc_ctx)
-            sc_sctx_r2, _ = util.epicenter_mapping(thr2, sc_sctx)
-
-            fc_epicentre_similarity_r[i, j], fc_epicentre_similarity_p[i, j], _ = (
-                util.spatial_correlation(
-                    np.concatenate((fc_ctx_r1, fc_sctx_r1)),
-                    np.concatenate((fc_ctx_r2, fc_sctx_r2)),
-                    surface_name="fsa5_with_sctx",
-                    parcellation_name="aparc_aseg",
-                    n_rot=5000,
-                )
-            )
-
-            sc_epicentre_similarity_r[i, j], sc_epicentre_similarity_p[i, j], _ = (
-                util.spatial_correlation(
-                    np.concatenate((sc_ctx_r1, sc_sctx_r1)),
-                    np.concatenate((sc_ctx_r2, sc_sctx_r2)),
-                    surface_name="fsa5_with_sctx",
-                    parcellation_name="aparc_aseg",
-                    n_rot=5000,
-                )
-            )
-
-            print(f"{thresholds[i]} x {thresholds[j]} done")
+    # Derive epicentre maps of all thresholds in one pass
+    thr_maps = np.vstack([regional_association[thr].t for thr in thresholds])
+    fc_ctx_r, fc_ctx_p = util.epicenter_mapping(thr_maps, fc_ctx, workers=workers)
+    fc_sctx_r, fc_sctx_p = util.epicenter_mapping(thr_maps, fc_sctx, workers=workers)
+    sc_ctx_r, sc_ctx_p = util.epicenter_mapping(thr_maps, sc_ctx, workers=workers)
+    sc_sctx_r, sc_sctx_p = util.epicenter_mapping(thr_maps, sc_sctx, workers=workers)
+
+    thr_fc_epicentre = np.concatenate((fc_ctx_r, fc_sctx_r), axis=1)
+    thr_sc_epicentre = np.concatenate((sc_ctx_r, sc_sctx_r), axis=1)
+
+    percent_fc_ctx = fc_ctx_p < 0.05
+    percent_fc_sctx = fc_sctx_p < 0.05
+    percent_sc_ctx = sc_ctx_p < 0.05
+    percent_sc_sctx = sc_sctx_p < 0.05
+
+    fc_epicentre_similarity_r, fc_epicentre_similarity_p = (
+        util.spatial_correlation_matrix(
+            thr_fc_epicentre,
+            thr_fc_epicentre,
+            surface_name="fsa5_with_sctx",
+            parcellation_name="aparc_aseg",
+            n_rot=5000,
+            workers=workers,
+        )
+    )
+    sc_epicentre_similarity_r, sc_epicentre_similarity_p = (
+        util.spatial_correlation_matrix(
+            thr_sc_epicentre,
+            thr_sc_epicentre,
+            surface_name="fsa5_with_sctx",
+            parcellation_name="aparc_aseg",
+            n_rot=5000,
+            workers=workers,
+        )
+    )
 
     percent_fc_ctx = np.mean(percent_fc_ctx, axis=0)
     percent_fc_sctx = np.mean(percent_fc_sctx, axis=0)
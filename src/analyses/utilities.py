@@ -1,25 +1,386 @@
+import atexit
+import copy
+import hashlib
+import inspect
+import io
+import json
+import multiprocessing
 import numpy as np
 import os
+import pandas as pd
 import pickle
+import resource
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, wraps
+from types import SimpleNamespace
+from scipy import linalg, sparse, stats
 from enigmatoolbox.permutation_testing import spin_test
+from enigmatoolbox.utils import parcel_to_surface
 from brainstat.stats.terms import FixedEffect
 from brainstat.stats.SLM import SLM
+from brainstat.stats._multiple_comparisons import stat_threshold
+
+# PRSice threshold columns of the PRS-TLE compared across thresholds (s05, s06)
+PRS_THRESHOLDS = [
+    "Pt_0.00100005",
+    "Pt_0.0500001",
+    "Pt_0.1",
+    "Pt_0.2",
+    "Pt_0.3",
+    "Pt_0.4",
+    "Pt_0.5",
+]
+
+
+# Configuration
+def config(name, default=None):
+    """
+    Read a pipeline setting from the PRS_TLE_<NAME> environment variable.
+
+    Parameters:
+    name (str): Name of the setting
+    default (any, optional): Value returned when the variable is not set. Default is None
+
+    Returns:
+    value (str or any): Value of the setting
+    """
+    return os.environ.get(f"PRS_TLE_{name.upper()}", default)
+
+
+def get_dtype(dtype=None):
+    """
+    Resolve the floating-point type of stored data and bulk matrix products
+
+    Factorizations and accumulations (QR, sums of squares, running moments) always run in
+    float64, whatever the precision.
+
+    Parameters:
+    dtype (numpy.dtype, optional): Data type. Default is PRS_TLE_PRECISION, or float64
+
+    Returns:
+    dtype (numpy.dtype): float32 or float64
+    """
+    dtype = np.dtype(config("precision", "float64") if dtype is None else dtype)
+    if dtype not in (np.float32, np.float64):
+        raise ValueError(f"Unsupported precision: {dtype}")
+    return dtype
+
+
+# Parallel execution
+def get_workers(workers=None):
+    """
+    Resolve the number of worker processes
+
+    Parameters:
+    workers (int, optional): Number of workers. Default is PRS_TLE_WORKERS, or 1
+
+    Returns:
+    workers (int): Number of workers
+    """
+    return int(config("workers", 1)) if workers is None else int(workers)
+
+
+def parallel_map(func, tasks, workers=None):
+    """
+    Apply a function to each task over a process pool, preserving the order of the tasks
+
+    Parameters:
+    func (callable): Picklable function
+    tasks (list of tuple): Positional arguments of each call
+    workers (int, optional): Number of workers. Default is PRS_TLE_WORKERS, or 1
+
+    Returns:
+    results (list): Result of each call
+    """
+    workers = min(get_workers(workers), len(tasks))
+    if workers <= 1:
+        return [func(*task) for task in tasks]
+    with ProcessPoolExecutor(workers) as executor:
+        return list(executor.map(func, *zip(*tasks)))
+
+
+# Profiling
+_profile_dir = config("profile")
+_profile = OrderedDict()
+_profile_start = (time.time(), time.perf_counter())
+
+
+def _cpu_time():
+    """
+    CPU time (user + system) of this process and of its terminated worker processes
+
+    Returns:
+    cpu_time (float): CPU time in seconds
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def _peak_rss():
+    """
+    Peak resident set size of this process and of its largest terminated worker process
+
+    Returns:
+    peak_rss (tuple of float): Peak RSS in MiB of this process and of the largest worker
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 2**20 if sys.platform == "darwin" else 2**10
+    return own / scale, children / scale
+
+
+class profiled:
+    """
+    Record wall time, CPU time, peak RSS and call counts of a section, used either as a
+    context manager (with profiled("name"): ...) or as a decorator (@profiled())
+
+    Sections are only recorded when PRS_TLE_PROFILE is set to a report directory at import
+    time, in which case JSON and CSV reports are written there when the process exits.
+    Otherwise decorated functions are returned unchanged and the context manager does
+    nothing. Nested sections are recorded independently, so their times overlap.
+
+    Parameters:
+    name (str, optional): Section name. Default is the name of the decorated function
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+        self._starts = []
+
+    def __call__(self, func):
+        if not _profile_dir:
+            return func
+        name = self.name or func.__qualname__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with profiled(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    def __enter__(self):
+        if _profile_dir:
+            self._starts.append((time.perf_counter(), _cpu_time(), _peak_rss()[0]))
+        return self
+
+    def __exit__(self, *exc):
+        if not _profile_dir:
+            return False
+        wall, cpu, rss = self._starts.pop()
+        peak_rss, peak_rss_workers = _peak_rss()
+        record = _profile.setdefault(
+            self.name,
+            {
+                "calls": 0,
+                "wall_time": 0.0,
+                "cpu_time": 0.0,
+                "max_wall_time": 0.0,
+                "rss_growth": 0.0,
+                "peak_rss": 0.0,
+                "peak_rss_workers": 0.0,
+            },
+        )
+        record["calls"] += 1
+        record["wall_time"] += time.perf_counter() - wall
+        record["cpu_time"] += _cpu_time() - cpu
+        record["max_wall_time"] = max(
+            record["max_wall_time"], time.perf_counter() - wall
+        )
+        # Growth of the process high-water mark while the section ran
+        record["rss_growth"] = max(record["rss_growth"], peak_rss - rss)
+        record["peak_rss"] = max(record["peak_rss"], peak_rss)
+        record["peak_rss_workers"] = max(record["peak_rss_workers"], peak_rss_workers)
+        return False
+
+
+def write_profile(dir_path=None):
+    """
+    Write the sections recorded so far to JSON and CSV profile reports, named after the
+    running script, its start time and its process id. Times are in seconds and memory in
+    MiB.
+
+    Parameters:
+    dir_path (str, optional): Report directory. Default is PRS_TLE_PROFILE
+
+    Returns:
+    file_path (str): Path of the reports without extension, or None if nothing was recorded
+    """
+    dir_path = dir_path or _profile_dir
+    # Worker processes only contribute through the CPU time and RSS of their parent
+    if not dir_path or not _profile or multiprocessing.parent_process() is not None:
+        return None
+    script = os.path.splitext(os.path.basename(sys.argv[0] or "python"))[0]
+    started = time.strftime("%Y%m%d-%H%M%S", time.localtime(_profile_start[0]))
+    file_path = f"{dir_path}/{script}_{started}_{os.getpid()}"
+    peak_rss, peak_rss_workers = _peak_rss()
+    sections = [{"section": name, **record} for name, record in _profile.items()]
+
+    os.makedirs(dir_path, exist_ok=True)
+    with open(f"{file_path}.json", "w") as f:
+        json.dump(
+            {
+                "script": script,
+                "argv": sys.argv,
+                "pid": os.getpid(),
+                "started": started,
+                "wall_time": time.perf_counter() - _profile_start[1],
+                "cpu_time": _cpu_time(),
+                "peak_rss": peak_rss,
+                "peak_rss_workers": peak_rss_workers,
+                "settings": {
+                    k: v for k, v in os.environ.items() if k.startswith("PRS_TLE_")
+                },
+                "sections": sections,
+            },
+            f,
+            indent=2,
+        )
+    pd.DataFrame(sections).to_csv(f"{file_path}.csv", index=False)
+    return file_path
+
+
+if _profile_dir:
+    atexit.register(write_profile)
+
+
+# Memoization
+def _update_hash(h, value):
+    """
+    Feed a value (arrays, scalars and nested containers) into a hash object
+
+    Parameters:
+    h (hashlib object): Hash to update
+    value (any): Value to hash
+    """
+    if isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        h.update(f"ndarray{value.dtype.str}{value.shape}".encode())
+        h.update(
+            repr(value.tolist()).encode() if value.dtype == object else value.tobytes()
+        )
+    elif isinstance(value, (pd.DataFrame, pd.Series)):
+        _update_hash(h, [type(value).__name__, list(value.axes[-1]), value.to_numpy()])
+    elif isinstance(value, (list, tuple)):
+        h.update(f"{type(value).__name__}{len(value)}".encode())
+        for v in value:
+            _update_hash(h, v)
+    elif isinstance(value, dict):
+        h.update(f"dict{len(value)}".encode())
+        for k in sorted(value, key=repr):
+            _update_hash(h, k)
+            _update_hash(h, value[k])
+    else:
+        h.update(repr(value).encode())
+
+
+@lru_cache(maxsize=None)
+def _code_version():
+    """
+    Hash of this module, so that memoized results are invalidated when the code changes
+
+    Returns:
+    version (str): Hex digest of the module source
+    """
+    with open(os.path.abspath(__file__), "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def memoize(ignore=(), settings=()):
+    """
+    Memoize a function on a content hash of its arguments
+
+    Results are kept in an in-process LRU cache of PRS_TLE_MEMO_SIZE entries (default 128)
+    and, if PRS_TLE_MEMO_DIR is set, in pickles under that directory across runs.
+
+    Parameters:
+    ignore (tuple of str, optional): Arguments that do not affect the result. Default is ()
+    settings (tuple of str, optional): Pipeline settings read by the function. Default is ()
+
+    Returns:
+    decorator (callable): Decorator applying the memo layer
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+        memo = OrderedDict()
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            h = hashlib.sha1()
+            _update_hash(h, [func.__qualname__, _code_version()])
+            _update_hash(h, [config(name) for name in settings])
+            for name, value in bound.arguments.items():
+                if name not in ignore:
+                    _update_hash(h, [name, value])
+            key = h.hexdigest()
+
+            if key in memo:
+                memo.move_to_end(key)
+                return copy.deepcopy(memo[key])
+
+            memo_dir = config("memo_dir")
+            file_path = (
+                f"{memo_dir}/{func.__qualname__}/{key}.pkl" if memo_dir else None
+            )
+            if file_path and os.path.exists(file_path):
+                result = load_result(file_path, ["result"])[0]
+            else:
+                result = func(*args, **kwargs)
+                if file_path:
+                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                    tmp_path = f"{file_path}.{os.getpid()}.tmp"
+                    save_to_pickle(tmp_path, {"result": result})
+                    os.replace(tmp_path, file_path)
+
+            memo[key] = result
+            if len(memo) > int(config("memo_size", 128)):
+                memo.popitem(last=False)
+            return copy.deepcopy(result)
+
+        wrapper.cache_clear = memo.clear
+        return wrapper
+
+    return decorator
 
 
 # Data loaders
+@profiled()
 def load_data(file_path, variables):
     """
-    Load specified variables from a .npz file.
+    Load specified variables from a processed data store (or a legacy .npz file).
+
+    Numerical variables are returned as read-only memory-mapped arrays, so only the pages
+    that are used get read and they are shared between processes. Categorical variables
+    are decoded from their integer codes into object arrays.
 
     Parameters:
-    file_path (str): The path to the .npz file.
-    variables (list of str): A list of variable names to extract from the .npz file.
+    file_path (str): The path to the data store directory (or .npz file).
+    variables (list of str): A list of variable names to extract from the store.
 
     Returns:
     tuple: A tuple containing the data for each specified variable in the order they are listed in the variables parameter.
     """
-    data = np.load(file_path, allow_pickle=True)
-    return tuple(data[var] for var in variables)
+    if not os.path.isdir(file_path):
+        data = np.load(file_path, allow_pickle=True)
+        return tuple(data[var] for var in variables)
+
+    data = []
+    for var in variables:
+        values = np.load(f"{file_path}/{var}.npy", mmap_mode="r")
+        if os.path.exists(f"{file_path}/{var}.labels.npy"):
+            labels = np.load(f"{file_path}/{var}.labels.npy").astype(object)
+            # Missing values are coded as -1, which indexes the appended NaN
+            values = np.append(labels, np.nan)[values]
+        data.append(values)
+    return tuple(data)
 
 
 def load_connectomes():
@@ -33,7 +394,7 @@ def load_connectomes():
     sc_sctx (array-like): Cortico-subcortical structural connectivity
     """
     return load_data(
-        f"{os.path.dirname(os.path.abspath(__file__))}/../../data/processed/hcp_data.npz",
+        f"{os.path.dirname(os.path.abspath(__file__))}/../../data/processed/hcp_data",
         ["fc_ctx", "fc_sctx", "sc_ctx", "sc_sctx"],
     )
 
@@ -76,9 +437,947 @@ def load_imaging_genetic(result):
         )
 
 
+# Spin permutations
+class _RotationsCaptured(Exception):
+    """Raised to stop spin_test once the rotation indices have been generated."""
+
+
+def generate_rotations(
+    surface_name="fsa5", parcellation_name="aparc", n_rot=5000, seed=0
+):
+    """
+    Generate spin permutation indices with the ENIGMA toolbox
+
+    The toolbox only builds rotations inside spin_test, so its rotate_parcellation
+    is intercepted to keep the sphere and centroid handling identical. spin_test looks it
+    up in the module that defines spin_test (enigmatoolbox.permutation_testing.
+    permutation_testing), not in the package that re-exports it, so that is the module
+    patched.
+
+    Parameters:
+    surface_name (str, optional): Name of surface. Default is 'fsa5'
+    parcellation_name (str, optional): Name of parcellation. Default is 'aparc'
+    n_rot (int, optional): Number of rotations. Default is 5000
+    seed (int, optional): Seed of the random rotations. Default is 0
+
+    Returns:
+    rotations (array-like): Region indices of each rotation (n_rot x n_region)
+    """
+    module = sys.modules[spin_test.__module__]
+    rotate_parcellation = module.rotate_parcellation
+    captured = {}
+
+    def capture(*args, **kwargs):
+        captured["perm_id"] = rotate_parcellation(*args, **kwargs)
+        raise _RotationsCaptured
+
+    state = np.random.get_state()
+    np.random.seed(seed)
+    module.rotate_parcellation = capture
+    try:
+        spin_test(
+            np.zeros(1),
+            np.zeros(1),
+            surface_name=surface_name,
+            parcellation_name=parcellation_name,
+            n_rot=n_rot,
+        )
+    except _RotationsCaptured:
+        pass
+    finally:
+        module.rotate_parcellation = rotate_parcellation
+        np.random.set_state(state)
+
+    if "perm_id" not in captured:
+        raise RuntimeError(
+            f"spin_test of {module.__name__} did not call rotate_parcellation"
+        )
+    return np.ascontiguousarray(captured["perm_id"].T).astype(np.int16)
+
+
+@lru_cache(maxsize=None)
+def load_rotations(surface_name="fsa5", parcellation_name="aparc", n_rot=5000, seed=0):
+    """
+    Load spin permutation indices from the on-disk cache, generating them on first use
+
+    Parameters:
+    surface_name (str, optional): Name of surface. Default is 'fsa5'
+    parcellation_name (str, optional): Name of parcellation. Default is 'aparc'
+    n_rot (int, optional): Number of rotations. Default is 5000
+    seed (int, optional): Seed of the random rotations. Default is 0
+
+    Returns:
+    rotations (array-like): Read-only memory-mapped region indices (n_rot x n_region)
+    """
+    cache_dir = f"{os.path.dirname(os.path.abspath(__file__))}/../../data/cache/spins"
+    file_path = (
+        f"{cache_dir}/{surface_name}_{parcellation_name}_nrot-{n_rot}_seed-{seed}.npy"
+    )
+    if not os.path.exists(file_path):
+        rotations = generate_rotations(surface_name, parcellation_name, n_rot, seed)
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{file_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, rotations)
+        os.replace(tmp_path, file_path)
+    return np.load(file_path, mmap_mode="r")
+
+
+def _standardize(maps):
+    """
+    Centre each map and scale it to unit norm so that dot products are Pearson correlations
+
+    Parameters:
+    maps (array-like): Spatial maps (n_map x n_region)
+
+    Returns:
+    z (array-like): Standardized maps (n_map x n_region)
+    """
+    centred = maps - np.mean(maps, axis=1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return centred / np.linalg.norm(centred, axis=1, keepdims=True)
+
+
+def _spin_chunk(za, zb, rot, return_null):
+    """
+    Spin permuted nulls of all pairs of standardized maps for a chunk of rotations
+
+    Parameters:
+    za (array-like): First set of standardized maps (n_a x n_region)
+    zb (array-like): Second set of standardized maps (n_b x n_region)
+    rot (array-like): Region indices of each rotation (n_chunk x n_region)
+    return_null (bool): Whether to return the null distributions
+
+    Returns:
+    exceed (array-like): Number of null correlations beyond the empirical one (n_a x n_b)
+    null_ab (array-like): Nulls of rotated za against zb (n_a x n_b x n_chunk), or None
+    null_ba (array-like): Nulls of rotated zb against za (n_a x n_b x n_chunk), or None
+    """
+    n_a, n_b, n_chunk = za.shape[0], zb.shape[0], rot.shape[0]
+    rot = np.asarray(rot, dtype=np.intp)
+    r_emp = (za @ zb.T)[:, :, None]
+
+    exceed = np.zeros((n_a, n_b))
+    nulls = []
+    # Rotating a against b equals rotating b with the inverse rotation against a
+    for idx in [np.argsort(rot, axis=1), rot]:
+        null = np.transpose(
+            (zb[:, idx].reshape(n_b * n_chunk, -1) @ za.T).reshape(n_b, n_chunk, n_a),
+            (2, 0, 1),
+        )
+        # p-value definition depends on the sign of the empirical correlation
+        exceed += np.where(r_emp >= 0, null > r_emp, null < r_emp).sum(axis=2)
+        nulls.append(null if return_null else None)
+
+    return exceed, nulls[0], nulls[1]
+
+
+def _spin_correlation(
+    maps_a,
+    maps_b,
+    rotations,
+    return_null=False,
+    chunk_size=1000,
+    workers=None,
+    alpha=None,
+    confidence=0.999,
+    batch_size=250,
+    dtype=None,
+):
+    """
+    Correlate every pair of maps and their spin permuted nulls in batched matrix products
+
+    Follows perm_sphere_p of the ENIGMA toolbox: nulls are obtained by rotating either map
+    against the other one, and the p-value averages both one-sided exceedance rates.
+    Rotation chunks are spread over worker processes; since the rotations are fixed, the
+    results do not depend on the number of workers.
+
+    With alpha, rotations are drawn sequentially in batches and a pair stops once the
+    Clopper-Pearson interval of its p-value lies entirely above or below alpha. Pairs that
+    never resolve use every rotation and get the same p-value as without alpha.
+
+    Maps are standardized and correlated in float64; only the null correlations are
+    computed (and returned) in dtype.
+
+    Parameters:
+    maps_a (array-like): First set of spatial maps (n_a x n_region)
+    maps_b (array-like): Second set of spatial maps (n_b x n_region)
+    rotations (array-like): Region indices of each rotation (n_rot x n_region)
+    return_null (bool, optional): Whether to keep the null distributions. Default is False
+    chunk_size (int, optional): Maximum number of rotations per chunk. Default is 1000
+    workers (int, optional): Number of worker processes. Default is PRS_TLE_WORKERS, or 1
+    alpha (float, optional): Decision threshold of the sequential mode. Default is None
+    confidence (float, optional): Confidence of the stopping interval. Default is 0.999
+    batch_size (int, optional): Rotations per sequential batch. Default is 250
+    dtype (numpy.dtype, optional): Data type of the null correlations. Default is
+        PRS_TLE_PRECISION, or float64
+
+    Returns:
+    r (array-like): Pearson's correlation coefficients (n_a x n_b)
+    p (array-like): Permutation-based p-values (n_a x n_b)
+    null (array-like): Null distributions, rotated maps_a followed by rotated maps_b
+        (n_a x n_b x 2 n_rot), or None if return_null is False
+    n_used (array-like): Number of rotations used for each pair (n_a x n_b)
+    """
+    if alpha is not None and return_null:
+        raise ValueError("Null distributions are not kept in the sequential mode")
+    za = _standardize(np.atleast_2d(np.asarray(maps_a, dtype=float)))
+    zb = _standardize(np.atleast_2d(np.asarray(maps_b, dtype=float)))
+    n_rot = rotations.shape[0]
+    r = za @ zb.T
+    dtype = get_dtype(dtype)
+    za, zb = za.astype(dtype, copy=False), zb.astype(dtype, copy=False)
+
+    workers = get_workers(workers)
+    batch_size = n_rot if alpha is None else batch_size
+    exceed = np.zeros(r.shape)
+    n_used = np.zeros(r.shape, dtype=int)
+    active = np.ones(r.shape, dtype=bool)
+    results = []
+    for batch in range(0, n_rot, batch_size):
+        rows, cols = np.any(active, axis=1), np.any(active, axis=0)
+        if not np.any(rows):
+            break
+        stop = min(batch + batch_size, n_rot)
+        size = min(chunk_size, -(-(stop - batch) // workers))
+        tasks = [
+            (
+                za[rows],
+                zb[cols],
+                np.asarray(rotations[start : min(start + size, stop)]),
+                return_null,
+            )
+            for start in range(batch, stop, size)
+        ]
+        results = parallel_map(_spin_chunk, tasks, workers)
+
+        block = np.ix_(rows, cols)
+        update = active[block]
+        exceed[block] += update * sum(ex for ex, _, _ in results)
+        n_used[block] += update * (stop - batch)
+        if alpha is not None:
+            k, m = exceed, 2 * n_used
+            with np.errstate(invalid="ignore"):
+                lower = stats.beta.ppf((1 - confidence) / 2, k, m - k + 1)
+                upper = stats.beta.ppf((1 + confidence) / 2, k + 1, m - k)
+            active &= ~(
+                (np.nan_to_num(lower) > alpha) | (np.nan_to_num(upper, nan=1) < alpha)
+            )
+    p = exceed / (2 * n_used)
+
+    null = None
+    if return_null:
+        null = np.concatenate(
+            [null_ab for _, null_ab, _ in results]
+            + [null_ba for _, _, null_ba in results],
+            axis=2,
+        )
+
+    return r, p, null, n_used
+
+
+def _spin_info(p, n_used):
+    """
+    Rotations used and Monte-Carlo standard error of spin p-values
+
+    Returns:
+    info (dict): Number of rotations ('n_rot') and Monte-Carlo error ('mc_error')
+    """
+    return {"n_rot": n_used, "mc_error": np.sqrt(p * (1 - p) / (2 * n_used))}
+
+
+# Linear models
+def nuisance_basis(design):
+    """
+    Orthonormal basis of the column space of a design matrix, from a rank-revealing QR
+
+    Redundant columns (e.g. dummy codes of every level next to an intercept, as built by
+    FixedEffect) are dropped.
+
+    Parameters:
+    design (array-like): Design matrix (n_sample x n_column)
+
+    Returns:
+    basis (array-like): Orthonormal basis (n_sample x rank)
+    """
+    q, r, _ = linalg.qr(np.asarray(design, dtype=float), mode="economic", pivoting=True)
+    diag = np.abs(np.diag(r))
+    if len(diag) == 0 or diag[0] == 0:
+        return q[:, :0]
+    rank = np.sum(diag > diag[0] * max(q.shape) * np.finfo(float).eps)
+    return q[:, :rank]
+
+
+@profiled()
+def residualize(data, design, chunk_size=8192, dtype=None, out=None):
+    """
+    Regress a design out of each feature, chunk by chunk
+
+    Equivalent to data - X @ coef of a fitted brainstat SLM, without holding the fitted
+    values of all features at once.
+
+    Parameters:
+    data (array-like): Participant x feature data (may be memory-mapped)
+    design (array-like): Nuisance design, e.g. FixedEffect(...).m (n_sample x n_column)
+    chunk_size (int, optional): Number of features per chunk. Default is 8192
+    dtype (numpy.dtype, optional): Data type of the projection and of the residuals.
+        Default is PRS_TLE_PRECISION, or float64
+    out (array-like, optional): Preallocated output, which may be data itself when writable
+
+    Returns:
+    out (array-like): Participant x feature residuals
+    """
+    dtype = get_dtype(dtype)
+    # The factorization stays in float64, only the projection runs in dtype
+    basis = nuisance_basis(design).astype(dtype, copy=False)
+    if out is None:
+        out = np.empty(data.shape, dtype=dtype)
+    for start in range(0, data.shape[1], chunk_size):
+        sl = slice(start, min(start + chunk_size, data.shape[1]))
+        # Copy, as the chunk of a read-only memory-mapped input is not writable
+        y = np.array(data[:, sl], dtype=dtype)
+        y -= basis @ (basis.T @ y)
+        out[:, sl] = y
+    return out
+
+
+def pearson(x, y, confidence=0.95):
+    """
+    Pearson correlation of every column of x with every column of y
+
+    All pairs come from one product of standardized matrices. P-values are two-tailed
+    (t-distribution with n - 2 degrees of freedom) and confidence intervals use the Fisher
+    z-transform, as in scipy.stats.pearsonr.
+
+    Parameters:
+    x (array-like): Participant x variable data (e.g. PRS at each threshold)
+    y (array-like): Participant x variable data (e.g. mean thickness of each lobe)
+    confidence (float, optional): Confidence level of the intervals. Default is 0.95
+
+    Returns:
+    r (array-like): Correlation coefficients (n_x x n_y)
+    r2 (array-like): Squared correlation coefficients (n_x x n_y)
+    p (array-like): Two-tailed p-values (n_x x n_y)
+    ci (array-like): Lower and upper confidence bounds (n_x x n_y x 2)
+    """
+    x = np.asarray(x, dtype=float).reshape(len(x), -1)
+    y = np.asarray(y, dtype=float).reshape(len(y), -1)
+    n = len(x)
+    zx, zy = _standardize(x.T), _standardize(y.T)
+    r = np.clip(zx @ zy.T, -1, 1)
+
+    df = n - 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = r * np.sqrt(df / ((1 - r) * (1 + r)))
+        p = 2 * stats.t.sf(np.abs(t), df)
+        z = np.arctanh(r)
+    half_width = stats.norm.ppf((1 + confidence) / 2) / np.sqrt(n - 3)
+    ci = np.tanh(np.stack((z - half_width, z + half_width), axis=-1))
+
+    return r, r**2, p, ci
+
+
+def _weighted_pearson(weights, x, y):
+    """
+    Pearson correlations of every column pair under participant weights (e.g. bootstrap
+    counts), from weighted sufficient statistics
+
+    Parameters:
+    weights (array-like): Weights of each participant (n_set x n_sample)
+    x (array-like): Centred participant x variable data
+    y (array-like): Centred participant x variable data
+
+    Returns:
+    r (array-like): Correlation coefficients (n_set x n_x x n_y)
+    """
+    n = np.sum(weights, axis=1)[:, None, None]
+    xy = (x[:, :, None] * y[:, None, :]).reshape(len(x), -1)
+    sums = weights @ np.hstack((x, y, x**2, y**2, xy))
+    n_x, n_y = x.shape[1], y.shape[1]
+    sx, sy, sxx, syy, sxy = np.split(sums, np.cumsum([n_x, n_y, n_x, n_y]), axis=1)
+    sx, sxx = sx[:, :, None], sxx[:, :, None]
+    sy, syy = sy[:, None, :], syy[:, None, :]
+    sxy = sxy.reshape(-1, n_x, n_y)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return (n * sxy - sx * sy) / np.sqrt((n * sxx - sx**2) * (n * syy - sy**2))
+
+
+def _bootstrap_block(x, y, seed, n_boot):
+    """
+    Bootstrapped correlations of one block of resamples
+
+    Returns:
+    r (array-like): Correlation coefficients (n_boot x n_x x n_y)
+    """
+    n = len(x)
+    # Multinomial counts of each participant, from resampled indices offset per resample
+    idx = np.random.default_rng(seed).integers(0, n, (n_boot, n))
+    idx += np.arange(n_boot)[:, None] * n
+    counts = np.bincount(idx.ravel(), minlength=n_boot * n).reshape(n_boot, n)
+    return _weighted_pearson(counts.astype(float), x, y)
+
+
+@profiled()
+@memoize(ignore=("workers",))
+def bootstrap_pearson(
+    x,
+    y,
+    n_boot=10000,
+    confidence=0.95,
+    method="bca",
+    seed=0,
+    block_size=500,
+    workers=None,
+):
+    """
+    Bootstrap confidence intervals of the Pearson correlation of every column of x with
+    every column of y
+
+    Resamples are drawn in blocks as counts per participant, and the correlations of all
+    pairs are computed at once from count-weighted sums.
+
+    Parameters:
+    x (array-like): Participant x variable data (e.g. PRS)
+    y (array-like): Participant x variable data (e.g. mean thickness of each lobe)
+    n_boot (int, optional): Number of resamples. Default is 10000
+    confidence (float, optional): Confidence level of the intervals. Default is 0.95
+    method (str, optional): 'percentile' or 'bca'. Default is 'bca'
+    seed (int, optional): Seed of the resamples. Default is 0
+    block_size (int, optional): Number of resamples per block. Default is 500
+    workers (int, optional): Number of worker processes. Default is PRS_TLE_WORKERS, or 1
+
+    Returns:
+    ci (array-like): Lower and upper confidence bounds (n_x x n_y x 2)
+    """
+    if method not in ("percentile", "bca"):
+        raise ValueError(f"Unknown bootstrap interval method: {method}")
+    x = np.asarray(x, dtype=float).reshape(len(x), -1)
+    y = np.asarray(y, dtype=float).reshape(len(y), -1)
+    x, y = x - np.mean(x, axis=0), y - np.mean(y, axis=0)
+    n = len(x)
+
+    sizes = [min(block_size, n_boot - start) for start in range(0, n_boot, block_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = [(x, y, s, size) for s, size in zip(seeds, sizes)]
+    r_boot = np.concatenate(parallel_map(_bootstrap_block, tasks, workers))
+
+    alpha = np.array([(1 - confidence) / 2, (1 + confidence) / 2])
+    if method == "percentile":
+        levels = np.broadcast_to(alpha, r_boot.shape[1:] + (2,))
+    else:
+        r = _weighted_pearson(np.ones((1, n)), x, y)[0]
+        # Bias correction
+        z0 = stats.norm.ppf(
+            np.clip(np.mean(r_boot < r, axis=0), 1 / n_boot, 1 - 1 / n_boot)
+        )
+        # Acceleration from the jackknife, with leave-one-out sums
+        jack = np.empty((n,) + r.shape)
+        for start in range(0, n, block_size):
+            idx = np.arange(start, min(start + block_size, n))
+            weights = np.ones((len(idx), n))
+            weights[np.arange(len(idx)), idx] = 0
+            jack[idx] = _weighted_pearson(weights, x, y)
+        d = np.mean(jack, axis=0) - jack
+        with np.errstate(divide="ignore", invalid="ignore"):
+            a = np.sum(d**3, axis=0) / (6 * np.sum(d**2, axis=0) ** 1.5)
+        z = z0[..., None] + stats.norm.ppf(alpha)
+        levels = stats.norm.cdf(z0[..., None] + z / (1 - a[..., None] * z))
+
+    ci = np.empty(r_boot.shape[1:] + (2,))
+    for idx in np.ndindex(*r_boot.shape[1:]):
+        ci[idx] = np.quantile(r_boot[(slice(None),) + idx], levels[idx])
+    return ci
+
+
+def fdr(p):
+    """
+    Benjamini-Hochberg q-values along the last axis
+
+    Parameters:
+    p (array-like): P-values (... x n_test)
+
+    Returns:
+    q (array-like): Q-values (... x n_test)
+    """
+    p = np.asarray(p, dtype=float)
+    n = p.shape[-1]
+    order = np.argsort(p, axis=-1)
+    q_sorted = np.take_along_axis(p, order, axis=-1) * n / np.arange(1, n + 1)
+    q_sorted = np.minimum.accumulate(q_sorted[..., ::-1], axis=-1)[..., ::-1]
+    q = np.empty_like(q_sorted)
+    np.put_along_axis(q, order, np.minimum(q_sorted, 1), axis=-1)
+    return q
+
+
+def _t_tail(t, df):
+    """
+    Upper-tail p-values of t-statistics, computed as brainstat does for peak p-values
+
+    Parameters:
+    t (array-like): T-statistics
+    df (int): Degrees of freedom
+
+    Returns:
+    p (array-like): One-tailed p-values, shaped like t
+    """
+    t = np.asarray(t, dtype=float)
+    p = stat_threshold(
+        df=np.array([[df, 0], [df, df]]),
+        p_val_peak=np.append(10, t.ravel()),
+        nvar=1,
+        nprint=0,
+    )[0][1:]
+    return p.reshape(t.shape)
+
+
+@profiled()
+def mass_univariate_glm(data, nuisance, effects, chunk_size=8192):
+    """
+    Fit one linear model per effect column and feature, sharing the nuisance design
+
+    The nuisance design is factorized once, and each effect is tested through
+    Frisch-Waugh-Lovell projections, so that all effects and features are fitted with a
+    few matrix products. Each result matches a brainstat SLM of nuisance + effect with the
+    effect as contrast (correction="fdr", two_tailed=True).
+
+    Parameters:
+    data (array-like): Participant x feature data
+    nuisance (array-like): Nuisance design, e.g. FixedEffect(...).m (n_sample x n_column)
+    effects (array-like): Effects of interest, one column per model (n_sample x n_effect)
+    chunk_size (int, optional): Number of features per chunk. Default is 8192
+
+    Returns:
+    results (list of SimpleNamespace): Per effect, t-values (t, 1 x n_feature), effect
+        sizes (ef), standard errors (sd), degrees of freedom (df), two-tailed p-values (p)
+        and FDR q-values (Q)
+    """
+    basis = nuisance_basis(nuisance)
+    effects = np.asarray(effects, dtype=float).reshape(len(basis), -1)
+    effects_r = effects - basis @ (basis.T @ effects)
+    ss_effects = np.sum(effects_r**2, axis=0)[:, None]
+    df = len(basis) - basis.shape[1] - 1
+
+    n_feature = data.shape[1]
+    ef = np.empty((effects.shape[1], n_feature))
+    sd = np.empty((effects.shape[1], n_feature))
+    for start in range(0, n_feature, chunk_size):
+        sl = slice(start, min(start + chunk_size, n_feature))
+        y = np.asarray(data[:, sl], dtype=float)
+        y = y - basis @ (basis.T @ y)
+        cross = effects_r.T @ y
+        sse = np.maximum(np.sum(y**2, axis=0) - cross**2 / ss_effects, 0)
+        ef[:, sl] = cross / ss_effects
+        sd[:, sl] = np.sqrt(sse / df / ss_effects)
+
+    return _glm_results(ef, sd, df)
+
+
+def _glm_results(ef, sd, df):
+    """
+    Two-tailed t-tests of fitted effects
+
+    Parameters:
+    ef (array-like): Effect sizes (n_effect x n_feature)
+    sd (array-like): Standard errors (n_effect x n_feature)
+    df (int): Degrees of freedom
+
+    Returns:
+    results (list of SimpleNamespace): Per effect, as returned by mass_univariate_glm
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = np.where(sd > 0, ef / sd, 0)
+    # Two-tailed tests merge both one-tailed tests, as brainstat does
+    p_pos, p_neg = _t_tail(t, df), _t_tail(-t, df)
+    p = np.minimum(2 * np.minimum(p_pos, p_neg), 1)
+    q = np.minimum(2 * np.minimum(fdr(p_pos), fdr(p_neg)), 1)
+
+    return [
+        SimpleNamespace(t=t[[i]], ef=ef[[i]], sd=sd[[i]], df=df, p=p[[i]], Q=q[i])
+        for i in range(len(t))
+    ]
+
+
+def glm_statistics(data, nuisance, effects, chunk_size=8192):
+    """
+    Sufficient statistics of the models of mass_univariate_glm, which add up across groups
+    of participants
+
+    Parameters:
+    data (array-like): Participant x feature data (may be memory-mapped)
+    nuisance (array-like): Nuisance design (n_sample x n_column)
+    effects (array-like): Effects of interest, one column per model (n_sample x n_effect)
+    chunk_size (int, optional): Number of features per chunk. Default is 8192
+
+    Returns:
+    statistics (dict): Number of participants ('n') and of nuisance columns ('n_nuisance'),
+        cross-products of the design ('xtx'), of the design and the data ('xty'), and sums
+        of squares of the data ('yty'), all accumulated in float64
+    """
+    n_sample, n_feature = data.shape
+    nuisance = np.asarray(nuisance, dtype=float).reshape(n_sample, -1)
+    design = np.hstack(
+        (nuisance, np.asarray(effects, dtype=float).reshape(n_sample, -1))
+    )
+    xty = np.empty((design.shape[1], n_feature))
+    yty = np.empty(n_feature)
+    for start in range(0, n_feature, chunk_size):
+        sl = slice(start, min(start + chunk_size, n_feature))
+        y = np.asarray(data[:, sl], dtype=float)
+        xty[:, sl] = design.T @ y
+        yty[sl] = np.einsum("ij,ij->j", y, y)
+    return {
+        "n": n_sample,
+        "n_nuisance": nuisance.shape[1],
+        "xtx": design.T @ design,
+        "xty": xty,
+        "yty": yty,
+    }
+
+
+def merge_glm_statistics(statistics, new):
+    """
+    Add the sufficient statistics of new participants to those of previous ones
+
+    Parameters:
+    statistics (dict): Statistics returned by glm_statistics
+    new (dict): Statistics of the new participants, with the same design columns
+
+    Returns:
+    statistics (dict): Statistics of all participants
+    """
+    if (
+        statistics["n_nuisance"] != new["n_nuisance"]
+        or statistics["xty"].shape != new["xty"].shape
+    ):
+        raise ValueError("Statistics of different designs cannot be merged")
+    return {
+        "n": statistics["n"] + new["n"],
+        "n_nuisance": statistics["n_nuisance"],
+        **{key: statistics[key] + new[key] for key in ["xtx", "xty", "yty"]},
+    }
+
+
+def glm_from_statistics(statistics):
+    """
+    Fit the models of mass_univariate_glm from their sufficient statistics
+
+    The nuisance block of the cross-products is inverted on its column space, so that
+    redundant columns (e.g. dummy codes next to an intercept) are handled as in
+    nuisance_basis, and each effect is then tested through Frisch-Waugh-Lovell identities.
+
+    Parameters:
+    statistics (dict): Statistics returned by glm_statistics or merge_glm_statistics
+
+    Returns:
+    results (list of SimpleNamespace): Per effect, as returned by mass_univariate_glm
+    """
+    k = statistics["n_nuisance"]
+    xtx, xty = statistics["xtx"], statistics["xty"]
+    # Pseudo-inverse of the scaled nuisance cross-products
+    scale = 1 / np.sqrt(np.maximum(np.diag(xtx)[:k], np.finfo(float).tiny))
+    w, v = linalg.eigh(xtx[:k, :k] * np.outer(scale, scale))
+    keep = w > w[-1] * k * np.finfo(float).eps * 100 if k else w > 0
+    inv = (scale[:, None] * v[:, keep] / w[keep]) @ (v[:, keep].T * scale)
+
+    ne = xtx[:k, k:]
+    ne_inv = inv @ ne
+    ss_effects = (np.diag(xtx)[k:] - np.sum(ne * ne_inv, axis=0))[:, None]
+    ss_y = statistics["yty"] - np.sum(xty[:k] * (inv @ xty[:k]), axis=0)
+    cross = xty[k:] - ne_inv.T @ xty[:k]
+    df = statistics["n"] - np.sum(keep) - 1
+
+    ef = cross / ss_effects
+    sse = np.maximum(ss_y - cross**2 / ss_effects, 0)
+    sd = np.sqrt(sse / df / ss_effects)
+    return _glm_results(ef, sd, df)
+
+
+@profiled()
+def accumulate_glm(file_path, data, nuisance, effects, chunk_size=8192):
+    """
+    Fit the models of mass_univariate_glm from sufficient statistics kept across cohort
+    updates
+
+    With PRS_TLE_INCREMENTAL set, the statistics stored in file_path by a previous run are
+    reused if the design rows of the participants they cover are unchanged, and only the
+    participants appended since then (the trailing rows of data) are read and added.
+    Otherwise the statistics are computed from every participant. Either way, they are
+    saved back to file_path.
+
+    Parameters:
+    file_path (str): The path to the pickle file of the statistics
+    data (array-like): Participant x feature data (may be memory-mapped)
+    nuisance (array-like): Nuisance design, e.g. FixedEffect(...).m (n_sample x n_column)
+    effects (array-like): Effects of interest, one column per model (n_sample x n_effect)
+    chunk_size (int, optional): Number of features per chunk. Default is 8192
+
+    Returns:
+    results (list of SimpleNamespace): Per effect, as returned by mass_univariate_glm
+    """
+    n_sample = data.shape[0]
+    nuisance = np.asarray(nuisance, dtype=float).reshape(n_sample, -1)
+    effects = np.asarray(effects, dtype=float).reshape(n_sample, -1)
+    design = np.hstack((nuisance, effects))
+
+    def design_hash(rows):
+        h = hashlib.sha1()
+        _update_hash(h, [nuisance.shape[1], design[:rows]])
+        return h.hexdigest()
+
+    statistics = None
+    if config("incremental") and os.path.exists(file_path):
+        stored = load_result(file_path, ["statistics"])[0]
+        if (
+            stored["n"] <= n_sample
+            and stored["xtx"].shape == (design.shape[1],) * 2
+            and stored["design_hash"] == design_hash(stored["n"])
+        ):
+            statistics = stored
+    if statistics is None:
+        statistics = glm_statistics(data, nuisance, effects, chunk_size)
+    elif statistics["n"] < n_sample:
+        new = slice(statistics["n"], n_sample)
+        statistics = merge_glm_statistics(
+            statistics,
+            glm_statistics(data[new], nuisance[new], effects[new], chunk_size),
+        )
+
+    statistics["design_hash"] = design_hash(n_sample)
+    os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+    tmp_path = f"{file_path}.{os.getpid()}.tmp"
+    save_to_pickle(tmp_path, {"statistics": statistics})
+    os.replace(tmp_path, file_path)
+    return glm_from_statistics(statistics)
+
+
+@profiled()
+def vertexwise_glm(data, nuisance, effect, dir_path, chunk_size=8192):
+    """
+    Fit the model of mass_univariate_glm for one effect at every vertex, out of core
+
+    Vertex blocks are streamed from data (e.g. the memory-mapped ct_vertex of a processed
+    data store) through one factorization of the nuisance design, and the maps are written
+    to disk block by block. Memory holds one participant x vertex block, plus the one-tailed
+    p-values of every vertex for the FDR correction.
+
+    Parameters:
+    data (array-like): Participant x vertex data (may be memory-mapped)
+    nuisance (array-like): Nuisance design, e.g. FixedEffect(...).m (n_sample x n_column)
+    effect (array-like): Effect of interest (n_sample)
+    dir_path (str): Output directory, receiving one .npy file per map (t, ef, sd, p, Q)
+    chunk_size (int, optional): Number of vertices per block. Default is 8192
+
+    Returns:
+    result (SimpleNamespace): Memory-mapped t-values (t), effect sizes (ef), standard
+        errors (sd), two-tailed p-values (p) and FDR q-values (Q) of each vertex, and
+        degrees of freedom (df)
+    """
+    basis = nuisance_basis(nuisance)
+    effect = np.asarray(effect, dtype=float).reshape(len(basis))
+    effect_r = effect - basis @ (basis.T @ effect)
+    ss_effect = np.sum(effect_r**2)
+    df = len(basis) - basis.shape[1] - 1
+
+    n_vertex = data.shape[1]
+    names = ["t", "ef", "sd", "p", "Q"]
+    os.makedirs(dir_path, exist_ok=True)
+    tmp_paths = {name: f"{dir_path}/{name}.{os.getpid()}.tmp" for name in names}
+    maps = {
+        name: np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=np.float64, shape=(n_vertex,)
+        )
+        for name, tmp_path in tmp_paths.items()
+    }
+    p_pos, p_neg = np.empty(n_vertex), np.empty(n_vertex)
+    for start in range(0, n_vertex, chunk_size):
+        sl = slice(start, min(start + chunk_size, n_vertex))
+        # Copy, as the chunk of a read-only memory-mapped input is not writable
+        y = np.array(data[:, sl], dtype=float)
+        y -= basis @ (basis.T @ y)
+        cross = effect_r @ y
+        sse = np.maximum(np.einsum("ij,ij->j", y, y) - cross**2 / ss_effect, 0)
+        ef = cross / ss_effect
+        sd = np.sqrt(sse / df / ss_effect)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = np.where(sd > 0, ef / sd, 0)
+        # Two-tailed tests merge both one-tailed tests, as in mass_univariate_glm
+        p_pos[sl], p_neg[sl] = _t_tail(t, df), _t_tail(-t, df)
+        maps["t"][sl], maps["ef"][sl], maps["sd"][sl] = t, ef, sd
+        maps["p"][sl] = np.minimum(2 * np.minimum(p_pos[sl], p_neg[sl]), 1)
+    maps["Q"][:] = np.minimum(2 * np.minimum(fdr(p_pos), fdr(p_neg)), 1)
+
+    for name in names:
+        maps[name].flush()
+    del maps
+    for name, tmp_path in tmp_paths.items():
+        os.replace(tmp_path, f"{dir_path}/{name}.npy")
+    t, ef, sd, p, q = load_data(dir_path, names)
+    return SimpleNamespace(t=t, ef=ef, sd=sd, df=df, p=p, Q=q)
+
+
+def _freedman_lane_block(data, basis, effect_r, t, seed, n_perm, chunk_size):
+    """
+    Permuted t-values of one block of Freedman-Lane permutations
+
+    Returns:
+    exceed (array-like): Number of permutations with |t*| >= |t| for each feature
+    max_t (array-like): Maximum |t*| over features for each permutation
+    """
+    n_sample, n_feature = data.shape
+    df = n_sample - basis.shape[1] - 1
+    ss_effect = effect_r @ effect_r
+    rng = np.random.default_rng(seed)
+    perms = np.argsort(rng.random((n_perm, n_sample)), axis=1)
+    # Permuting the design rather than the residuals gives the same statistics
+    w = np.hstack((effect_r[:, None], basis))[perms]
+
+    exceed = np.zeros(n_feature)
+    max_t = np.zeros(n_perm)
+    for start in range(0, n_feature, chunk_size):
+        sl = slice(start, min(start + chunk_size, n_feature))
+        y = np.array(data[:, sl], dtype=float)
+        y -= basis @ (basis.T @ y)
+        proj = np.matmul(w.transpose(0, 2, 1), y)
+        cross = proj[:, 0]
+        sse = np.sum(y**2, axis=0) - np.sum(proj[:, 1:] ** 2, axis=1)
+        sse = np.maximum(sse - cross**2 / ss_effect, 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t_perm = np.abs(np.where(sse > 0, cross / np.sqrt(sse * ss_effect / df), 0))
+        exceed[sl] = np.sum(t_perm >= np.abs(t[sl]), axis=0)
+        max_t = np.maximum(max_t, np.max(t_perm, axis=1))
+    return exceed, max_t
+
+
+@profiled()
+@memoize(ignore=("workers",))
+def freedman_lane(
+    data,
+    nuisance,
+    effect,
+    n_perm=10000,
+    seed=0,
+    block_size=100,
+    chunk_size=8192,
+    workers=None,
+):
+    """
+    Permutation inference for one effect with covariates, following Freedman and Lane
+
+    Residuals of the nuisance-only model are permuted and added back to its fitted values.
+    The nuisance projection is computed once, and each block of permutations is evaluated
+    as one batched (permutation x design x feature) matrix product over feature chunks.
+
+    Parameters:
+    data (array-like): Participant x feature data
+    nuisance (array-like): Nuisance design, e.g. FixedEffect(...).m (n_sample x n_column)
+    effect (array-like): Effect of interest (n_sample)
+    n_perm (int, optional): Number of permutations. Default is 10000
+    seed (int, optional): Seed of the permutations. Default is 0
+    block_size (int, optional): Number of permutations per block. Default is 100
+    chunk_size (int, optional): Number of features per chunk. Default is 8192
+    workers (int, optional): Number of worker processes. Default is PRS_TLE_WORKERS, or 1
+
+    Returns:
+    t (array-like): Observed t-values (1 x n_feature)
+    p (array-like): Two-tailed permutation p-values of each feature (n_feature)
+    p_fwe (array-like): Family-wise (max-T) p-values of each feature (n_feature)
+    """
+    basis = nuisance_basis(nuisance)
+    effect = np.asarray(effect, dtype=float).ravel()
+    effect_r = effect - basis @ (basis.T @ effect)
+    t = mass_univariate_glm(data, nuisance, effect, chunk_size=chunk_size)[0].t
+
+    sizes = [min(block_size, n_perm - start) for start in range(0, n_perm, block_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = [
+        (data, basis, effect_r, t[0], s, size, chunk_size)
+        for s, size in zip(seeds, sizes)
+    ]
+    blocks = parallel_map(_freedman_lane_block, tasks, workers)
+    exceed = np.sum([b[0] for b in blocks], axis=0)
+    max_t = np.concatenate([b[1] for b in blocks])
+
+    p = (exceed + 1) / (n_perm + 1)
+    p_fwe = (np.sum(max_t[:, None] >= np.abs(t[0]), axis=0) + 1) / (n_perm + 1)
+    return t, p, p_fwe
+
+
+# Surface aggregation
+def surface_averaging_matrix(groups, target_lab="aparc_conte69", n_parcel=68):
+    """
+    Sparse matrix averaging vertex-wise data within groups of parcels
+
+    The matrix is cached on disk, keyed by the group definitions, so that the parcellation
+    is only mapped to the surface once. Multiplying participant x vertex data by it yields
+    all group means at once, without copying the vertices of each group.
+
+    Parameters:
+    groups (dict): Parcel indices of each group, or 'lh', 'rh' or 'all' for every vertex of
+        a hemisphere or of the surface
+    target_lab (str, optional): Surface parcellation. Default is 'aparc_conte69'
+    n_parcel (int, optional): Number of parcels. Default is 68
+
+    Returns:
+    matrix (scipy.sparse.csr_matrix): Averaging weights (n_vertex x n_group)
+    """
+    definition = json.dumps(
+        [
+            target_lab,
+            n_parcel,
+            [
+                [name, g if isinstance(g, str) else [int(i) for i in g]]
+                for name, g in groups.items()
+            ],
+        ]
+    )
+    key = hashlib.sha1(definition.encode()).hexdigest()
+    cache_dir = (
+        f"{os.path.dirname(os.path.abspath(__file__))}/../../data/cache/averaging"
+    )
+    file_path = f"{cache_dir}/{target_lab}_{key}.npz"
+    if os.path.exists(file_path):
+        return sparse.load_npz(file_path)
+
+    vertex_parcel = parcel_to_surface(np.arange(1, n_parcel + 1), target_lab)
+    n_vertex = len(vertex_parcel)
+    half = n_vertex // 2
+    rows, cols, weights = [], [], []
+    for j, g in enumerate(groups.values()):
+        if isinstance(g, str):
+            mask = np.zeros(n_vertex, dtype=bool)
+            mask[
+                {"lh": slice(0, half), "rh": slice(half, None), "all": slice(None)}[g]
+            ] = True
+        else:
+            mask = np.isin(vertex_parcel, np.asarray(g) + 1)
+        idx = np.flatnonzero(mask)
+        rows.append(idx)
+        cols.append(np.full(len(idx), j))
+        weights.append(np.full(len(idx), 1 / len(idx)))
+    matrix = sparse.csr_matrix(
+        (np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(n_vertex, len(groups)),
+    )
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{file_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        sparse.save_npz(f, matrix)
+    os.replace(tmp_path, file_path)
+    return matrix
+
+
 # Analysis functions
+@profiled()
+@memoize(ignore=("workers",), settings=("precision",))
 def spatial_correlation(
-    map1, map2, n_rot=5000, surface_name="fsa5", parcellation_name="aparc"
+    map1,
+    map2,
+    n_rot=5000,
+    surface_name="fsa5",
+    parcellation_name="aparc",
+    seed=0,
+    workers=None,
 ):
     """
     Calculate the spatial correlation between two maps and perform a spin permuation spin_test
@@ -89,45 +1388,120 @@ def spatial_correlation(
     n_rot (int, optional): Number of rotations. Default is 5000
     surface_name (str, optional): Name of surface. Default is 'fsa5'
     parcellation_name (str, optional): Name of parcellation. Default is 'aparc'
+    seed (int, optional): Seed of the cached rotations. Default is 0
+    workers (int, optional): Number of worker processes. Default is PRS_TLE_WORKERS, or 1
 
     Returns:
     r (float): Pearson's correlation coefficient between map1 and map2
     p (float): Permutation-based p-pvalue
     null (array-like): Null distribution from the permuation spin_test
     """
-    r = np.corrcoef(map1, map2)[0, 1]
-    p, null = spin_test(
-        map1.flatten(),
-        map2.flatten(),
-        surface_name=surface_name,
-        parcellation_name=parcellation_name,
-        n_rot=n_rot,
-        null_dist=True,
+    rotations = load_rotations(surface_name, parcellation_name, n_rot, seed)
+    r, p, null, _ = _spin_correlation(
+        np.ravel(map1), np.ravel(map2), rotations, return_null=True, workers=workers
     )
 
-    return r, p, null
+    return r[0, 0], p[0, 0], null[0, 0]
 
 
-def epicenter_mapping(map, connectome):
+@profiled()
+@memoize(ignore=("workers",), settings=("spin_alpha", "precision"))
+def spatial_correlation_matrix(
+    maps_a,
+    maps_b,
+    n_rot=5000,
+    surface_name="fsa5",
+    parcellation_name="aparc",
+    seed=0,
+    return_null=False,
+    return_info=False,
+    workers=None,
+):
     """
-    Map epicentres of a given map to a connectome
+    Calculate the spatial correlation between every pair of maps of two sets, sharing the
+    spin permuted nulls of each map across all pairs
+
+    If PRS_TLE_SPIN_ALPHA is set (and no nulls are requested), rotations are drawn
+    sequentially and each pair stops as soon as its p-value is resolved against that alpha.
 
     Parameters:
-    map (array-like): Spatial map
-    connectome (array-like): Connectome matrix
+    maps_a (array-like): First set of spatial maps (n_a x n_region)
+    maps_b (array-like): Second set of spatial maps (n_b x n_region)
+    n_rot (int, optional): Maximum number of rotations. Default is 5000
+    surface_name (str, optional): Name of surface. Default is 'fsa5'
+    parcellation_name (str, optional): Name of parcellation. Default is 'aparc'
+    seed (int, optional): Seed of the cached rotations. Default is 0
+    return_null (bool, optional): Whether to return the null distributions. Default is False
+    return_info (bool, optional): Whether to return rotations used and Monte-Carlo errors.
+        Default is False
+    workers (int, optional): Number of worker processes. Default is PRS_TLE_WORKERS, or 1
 
     Returns:
-    epi_r (array-like): Correlation coefficients of each seed regions
-    epi_p (array-like): Permuation-based p-values of each seed regions
+    r (array-like): Pearson's correlation coefficients (n_a x n_b)
+    p (array-like): Permutation-based p-values (n_a x n_b)
+    null (array-like): Null distributions of each pair (n_a x n_b x 2 n_rot), only if return_null
+    info (dict): Rotations used ('n_rot') and Monte-Carlo errors ('mc_error') of each pair,
+        only if return_info
     """
-    epi_r = []
-    epi_p = []
-    for seed in range(connectome.shape[0]):
-        seed_con = connectome[seed, :]
-        r, p, _ = spatial_correlation(seed_con, map)
-        epi_r = np.append(epi_r, r)
-        epi_p = np.append(epi_p, p)
+    rotations = load_rotations(surface_name, parcellation_name, n_rot, seed)
+    alpha = (
+        None
+        if return_null or config("spin_alpha") is None
+        else float(config("spin_alpha"))
+    )
+    r, p, null, n_used = _spin_correlation(
+        maps_a, maps_b, rotations, return_null=return_null, workers=workers, alpha=alpha
+    )
 
+    outputs = (r, p)
+    if return_null:
+        outputs += (null,)
+    if return_info:
+        outputs += (_spin_info(p, n_used),)
+    return outputs
+
+
+@profiled()
+@memoize(ignore=("workers",), settings=("spin_alpha", "precision"))
+def epicenter_mapping(
+    map, connectome, n_rot=5000, seed=0, return_info=False, workers=None
+):
+    """
+    Map epicentres of one or several maps to a connectome
+
+    Every seed region is correlated with every map against the same spin permuted nulls,
+    which is equivalent to calling spatial_correlation(connectome[seed, :], map) per seed.
+    If PRS_TLE_SPIN_ALPHA is set, rotations are drawn sequentially and each seed stops as
+    soon as its p-value is resolved against that alpha.
+
+    Parameters:
+    map (array-like): Spatial map (n_region) or stack of maps (n_map x n_region)
+    connectome (array-like): Connectome matrix (n_seed x n_region)
+    n_rot (int, optional): Maximum number of rotations. Default is 5000
+    seed (int, optional): Seed of the cached rotations. Default is 0
+    return_info (bool, optional): Whether to return rotations used and Monte-Carlo errors.
+        Default is False
+    workers (int, optional): Number of worker processes. Default is PRS_TLE_WORKERS, or 1
+
+    Returns:
+    epi_r (array-like): Correlation coefficients of each seed regions (n_seed or n_map x n_seed)
+    epi_p (array-like): Permuation-based p-values of each seed regions (n_seed or n_map x n_seed)
+    info (dict): Rotations used ('n_rot') and Monte-Carlo errors ('mc_error') of each seed
+        region, only if return_info
+    """
+    maps = np.atleast_2d(np.asarray(map, dtype=float))
+    rotations = load_rotations("fsa5", "aparc", n_rot, seed)
+    alpha = None if config("spin_alpha") is None else float(config("spin_alpha"))
+    r, p, _, n_used = _spin_correlation(
+        connectome, maps, rotations, workers=workers, alpha=alpha
+    )
+    epi_r, epi_p, info = r.T, p.T, _spin_info(p.T, n_used.T)
+
+    if maps.shape[0] == 1:
+        epi_r, epi_p = epi_r[0], epi_p[0]
+        info = {key: value[0] for key, value in info.items()}
+    if return_info:
+        return epi_r, epi_p, info
     return epi_r, epi_p
 
 
@@ -160,6 +1534,7 @@ def zscore_flip(data, group, control, flip):
     return f
 
 
+@profiled()
 def casecontrol_difference(data, covar, group, control, patient):
     """
     Compute between-group differents using a fixed effect model
@@ -183,7 +1558,273 @@ def casecontrol_difference(data, covar, group, control, patient):
     return slm
 
 
+# Data savers
+def save_data(dir_path, data):
+    """
+    Save the given variables to a processed data store, one raw .npy file per variable.
+
+    Non-numerical variables (e.g. sex, site, group) are stored as integer codes alongside a
+    <variable>.labels.npy table of their unique values, so that no file needs pickling.
+
+    Parameters:
+    dir_path (str): The path to the data store directory.
+    data (dict): The variables to be saved in the store.
+    """
+    os.makedirs(dir_path, exist_ok=True)
+    for var, values in data.items():
+        values = np.asarray(
+            values.to_numpy() if hasattr(values, "to_numpy") else values
+        )
+        arrays = {var: values}
+        if values.dtype.kind not in "biuf":
+            codes, labels = pd.factorize(values.ravel())
+            dtype = np.int16 if len(labels) < np.iinfo(np.int16).max else np.int32
+            arrays = {
+                var: codes.astype(dtype).reshape(values.shape),
+                f"{var}.labels": np.asarray(labels, dtype=str),
+            }
+        elif os.path.exists(f"{dir_path}/{var}.labels.npy"):
+            os.remove(f"{dir_path}/{var}.labels.npy")
+
+        for name, array in arrays.items():
+            tmp_path = f"{dir_path}/{name}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, np.ascontiguousarray(array), allow_pickle=False)
+            os.replace(tmp_path, f"{dir_path}/{name}.npy")
+
+
+def _append_npy(file_path, rows, start=None):
+    """
+    Append rows to a .npy file in place, rewriting the file only if its header cannot be
+    updated in place
+
+    The rows are written after the existing data before the shape in the header is
+    updated, so an interrupted append leaves the previous array readable.
+
+    Parameters:
+    file_path (str): The path to the .npy file
+    rows (array-like): Rows to append, with the trailing dimensions of the stored array
+    start (int, optional): Number of stored rows to keep. Default is all of them
+    """
+    with open(file_path, "r+b") as f:
+        version = np.lib.format.read_magic(f)
+        read_header, write_header = {
+            (1, 0): (
+                np.lib.format.read_array_header_1_0,
+                np.lib.format.write_array_header_1_0,
+            ),
+            (2, 0): (
+                np.lib.format.read_array_header_2_0,
+                np.lib.format.write_array_header_2_0,
+            ),
+        }.get(version, (None, None))
+        if read_header is not None:
+            shape, fortran_order, dtype = read_header(f)
+            offset = f.tell()
+            rows = np.ascontiguousarray(rows, dtype=dtype)
+            if fortran_order or len(shape) == 0 or rows.shape[1:] != shape[1:]:
+                raise ValueError(f"Rows of shape {rows.shape} do not fit {file_path}")
+            start = shape[0] if start is None else start
+            if start > shape[0]:
+                raise ValueError(f"{file_path} has fewer than {start} rows")
+            shape = (start, *shape[1:])
+            header = io.BytesIO()
+            write_header(
+                header,
+                {
+                    "descr": np.lib.format.dtype_to_descr(dtype),
+                    "fortran_order": False,
+                    "shape": (shape[0] + len(rows), *shape[1:]),
+                },
+            )
+            # numpy pads headers so that the growing dimension can be rewritten in place
+            if header.tell() == offset:
+                f.seek(offset + int(np.prod(shape)) * dtype.itemsize)
+                f.write(rows.tobytes())
+                f.truncate()
+                f.flush()
+                f.seek(0)
+                f.write(header.getvalue())
+                return
+
+    values = np.load(file_path)[:start]
+    tmp_path = f"{file_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, np.concatenate([values, np.asarray(rows, dtype=values.dtype)]))
+    os.replace(tmp_path, file_path)
+
+
+def append_data(dir_path, data, start=None):
+    """
+    Append participants to the variables of a processed data store without rewriting it
+
+    Non-numerical variables are appended as integer codes, adding unseen values to the end
+    of their label table. Variables are appended in order, so an update interrupted midway
+    can be redone with the same start row.
+
+    Parameters:
+    dir_path (str): The path to the data store directory.
+    data (dict): The rows to append to each variable, keyed by variable name.
+    start (int, optional): Number of stored rows to keep. Default is all of them.
+    """
+    for var, values in data.items():
+        values = np.asarray(
+            values.to_numpy() if hasattr(values, "to_numpy") else values
+        )
+        file_path = f"{dir_path}/{var}.npy"
+        labels_path = f"{dir_path}/{var}.labels.npy"
+        if os.path.exists(labels_path):
+            labels = pd.Index(np.load(labels_path).astype(object))
+            flat = values.ravel()
+            unseen = pd.unique(flat[~pd.isna(flat) & (labels.get_indexer(flat) < 0)])
+            if len(unseen):
+                labels = labels.append(pd.Index(unseen))
+                tmp_path = f"{dir_path}/{var}.labels.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    np.save(f, np.asarray(labels, dtype=str), allow_pickle=False)
+                os.replace(tmp_path, labels_path)
+            # Missing values are coded as -1, as in save_data
+            values = labels.get_indexer(flat).reshape(values.shape)
+            codes = np.load(file_path, mmap_mode="r")
+            if len(labels) >= np.iinfo(codes.dtype).max:
+                # Codes are widened as save_data would store them
+                codes = np.asarray(codes, dtype=np.int32)
+                tmp_path = f"{file_path}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    np.save(f, codes, allow_pickle=False)
+                os.replace(tmp_path, file_path)
+        _append_npy(file_path, values, start)
+
+
+# Null distributions
+def _analyses_path(file_path):
+    """
+    Resolve a path given relative to the analyses directory, whatever the working directory
+
+    Parameters:
+    file_path (str): Absolute path, or path relative to the analyses directory
+
+    Returns:
+    file_path (str): Absolute path
+    """
+    if os.path.isabs(file_path):
+        return file_path
+    return os.path.normpath(f"{os.path.dirname(os.path.abspath(__file__))}/{file_path}")
+
+
+class NullDistribution:
+    """
+    Spin null distribution stored in a compressed sidecar file and loaded on demand
+
+    Only the file reference and a quantile summary are pickled with the results; the
+    values are read (and cached) the first time they are needed, e.g. by np.asarray(null).
+    """
+
+    levels = np.linspace(0, 1, 501)
+
+    def __init__(self, file_path, key, quantiles, size):
+        self.file_path = file_path
+        self.key = key
+        self.quantiles = quantiles
+        self.size = size
+        self._values = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_values"] = None
+        return state
+
+    def __len__(self):
+        return self.size
+
+    def __array__(self, dtype=None, copy=None):
+        return self.values if dtype is None else self.values.astype(dtype)
+
+    @property
+    def values(self):
+        """Null correlations (n_null), dequantized to float64"""
+        if self._values is None:
+            with np.load(_analyses_path(self.file_path)) as f:
+                values = f[self.key]
+            if values.dtype == np.int16:
+                values = values / np.iinfo(np.int16).max
+            self._values = values.astype(np.float64)
+        return self._values
+
+    def p_value(self, r, exact=False):
+        """
+        Spin p-value of a correlation against the null
+
+        Parameters:
+        r (float): Empirical correlation
+        exact (bool, optional): Whether to use the stored values rather than the quantile
+            summary (accurate to 1/500). Default is False
+
+        Returns:
+        p (float): Fraction of the null beyond r, on the side of its sign
+        """
+        if exact:
+            return np.mean(self.values > r) if r >= 0 else np.mean(self.values < r)
+        below = np.interp(r, self.quantiles, self.levels)
+        return 1 - below if r >= 0 else below
+
+
+def compact_nulls(file_path, results, dtype=np.int16):
+    """
+    Move the null distributions of nested results into a compressed sidecar file
+
+    Every array stored under a key starting with 'null' is written as its own member of
+    a compressed .npz file, as quantized int16 (resolution 3e-5) or float32 correlations,
+    and replaced by a NullDistribution. Relative paths are resolved against the analyses
+    directory both here and when the nulls are read, so the results can be saved and
+    loaded from any working directory.
+
+    Parameters:
+    file_path (str): The path to the .npz file, relative to the analyses directory
+    results (dict): Nested results holding null arrays
+    dtype (numpy.dtype, optional): int16 or float32. Default is int16
+
+    Returns:
+    results (dict): Results with NullDistribution objects in place of the null arrays
+    """
+    arrays = {}
+
+    def compact(node, path):
+        if not isinstance(node, dict):
+            return node
+        out = {}
+        for k, v in node.items():
+            key = f"{path}{k}"
+            if str(k).startswith("null") and isinstance(v, np.ndarray):
+                values = np.ravel(v)
+                if np.dtype(dtype) == np.int16:
+                    scale = np.iinfo(np.int16).max
+                    arrays[key] = np.round(np.clip(values, -1, 1) * scale).astype(
+                        np.int16
+                    )
+                else:
+                    arrays[key] = values.astype(dtype)
+                quantiles = np.quantile(values, NullDistribution.levels).astype(
+                    np.float32
+                )
+                out[k] = NullDistribution(file_path, key, quantiles, len(values))
+            else:
+                out[k] = compact(v, f"{key}/")
+        return out
+
+    results = compact(results, "")
+    # The reference keeps the given path, so that the results move with the repository
+    sidecar_path = _analyses_path(file_path)
+    os.makedirs(os.path.dirname(sidecar_path), exist_ok=True)
+    tmp_path = f"{sidecar_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(tmp_path, sidecar_path)
+    return results
+
+
 # Result savers
+@profiled()
 def save_to_pickle(file_path, data):
     """
     Save the given data to a pickle file.
@@ -0,0 +1,274 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import pipeline
+import synthetic
+
+
+# Workspace
+def make_workspace(dir_path):
+    """
+    Copy the source tree into a workspace, next to which synthetic data is written, so
+    that benchmarks never touch the real data directories
+
+    Parameters:
+    dir_path (str): Workspace directory
+    """
+    shutil.copytree(
+        f"{pipeline.ROOT}/src",
+        f"{dir_path}/src",
+        ignore=shutil.ignore_patterns("__pycache__"),
+    )
+
+
+def _dir_size(dir_path):
+    """
+    Total size of the files under a directory
+
+    Parameters:
+    dir_path (str): Directory
+
+    Returns:
+    size (int): Size in bytes
+    """
+    return sum(
+        os.path.getsize(os.path.join(root, f))
+        for root, _, files in os.walk(dir_path)
+        for f in files
+    )
+
+
+# Measurement
+# Linux keeps the peak RSS of a process across exec, so a script started by the benchmark
+# would report the memory of the benchmark itself whenever it uses less. Scripts are
+# therefore started by a small launcher, which reports the resource usage of its child.
+_LAUNCHER = """
+import json, os, subprocess, sys
+process = subprocess.Popen(sys.argv[2:])
+_, status, rusage = os.wait4(process.pid, 0)
+with open(sys.argv[1], "w") as f:
+    json.dump([rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss], f)
+sys.exit(os.waitstatus_to_exitcode(status))
+"""
+
+
+def run_script(script, env, log_path):
+    """
+    Run a script from its own directory and measure its wall time, CPU time and peak RSS,
+    including those of the worker processes it waited for
+
+    Parameters:
+    script (str): Path to the script
+    env (dict): Environment variables of the script
+    log_path (str): File receiving the output of the script
+
+    Returns:
+    usage (dict): Exit code, wall time (s), user and system CPU time (s) and peak RSS (MiB)
+    """
+    usage_path = f"{log_path}.usage.json"
+    with open(log_path, "w") as log:
+        start = time.perf_counter()
+        returncode = subprocess.call(
+            [
+                sys.executable,
+                "-c",
+                _LAUNCHER,
+                usage_path,
+                sys.executable,
+                os.path.basename(script),
+            ],
+            cwd=os.path.dirname(script),
+            env=env,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+        wall_time = time.perf_counter() - start
+    with open(usage_path) as f:
+        user_time, system_time, max_rss = json.load(f)
+    os.remove(usage_path)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 2**20 if sys.platform == "darwin" else 2**10
+    return {
+        "returncode": returncode,
+        "wall_time": wall_time,
+        "user_time": user_time,
+        "system_time": system_time,
+        "peak_rss": max_rss / scale,
+    }
+
+
+def benchmark(scales, targets=(), workers=None, work_dir=None, keep=False, seed=0):
+    """
+    Time the dataset and analysis stages on synthetic data at several ABCD sample sizes
+
+    Each scale gets a fresh workspace with a copy of the source tree and a synthetic raw
+    dataset; the selected stages (and their dependencies) then run in pipeline order, as
+    separate processes without a persistent memo cache. Stages downstream of a failed stage
+    are recorded as skipped.
+
+    Parameters:
+    scales (list of int): Numbers of ABCD participants
+    targets (list of str, optional): Stages to benchmark. Default is all stages
+    workers (int, optional): Number of worker processes per stage. Default is PRS_TLE_WORKERS
+    work_dir (str, optional): Parent directory of the workspaces. Default is the system temp
+    keep (bool, optional): Keep the workspaces. Default is False
+    seed (int, optional): Random seed of the synthetic data. Default is 0
+
+    Returns:
+    results (DataFrame): Status ('done', 'fail' or 'skipped'), wall time, CPU time, peak
+        RSS and throughput of each stage and scale
+    """
+    upstream = pipeline.build_dag(pipeline.STAGES)
+    selected = pipeline.select_stages(upstream, targets)
+    env = {k: v for k, v in os.environ.items() if not k.startswith("PRS_TLE_MEMO")}
+    if workers is not None:
+        env["PRS_TLE_WORKERS"] = str(workers)
+
+    rows = []
+    for n in scales:
+        workspace = tempfile.mkdtemp(prefix=f"prs_tle_benchmark_{n}_", dir=work_dir)
+        failed = set()
+        try:
+            make_workspace(workspace)
+            os.makedirs(f"{workspace}/logs")
+            start = time.perf_counter()
+            synthetic.generate(f"{workspace}/{pipeline.RAW}", n_abcd=n, seed=seed)
+            raw_size = _dir_size(f"{workspace}/{pipeline.RAW}") / 2**20
+            print(
+                f"{n} participants: {raw_size:.0f} MiB of raw data written in "
+                f"{time.perf_counter() - start:.1f} s ({workspace})"
+            )
+
+            for stage in pipeline.STAGES:
+                if stage["name"] not in selected:
+                    continue
+                if upstream[stage["name"]] & failed:
+                    failed.add(stage["name"])
+                    rows.append(
+                        {
+                            "n_participant": n,
+                            "stage": stage["name"],
+                            "status": "skipped",
+                        }
+                    )
+                    print(f"[skipped] {stage['name']}")
+                    continue
+                for output in stage["outputs"]:
+                    os.makedirs(os.path.dirname(f"{workspace}/{output}"), exist_ok=True)
+                usage = run_script(
+                    f"{workspace}/{stage['script']}",
+                    env,
+                    f"{workspace}/logs/{stage['name']}.log",
+                )
+                status = "done" if usage["returncode"] == 0 else "fail"
+                rows.append(
+                    {
+                        "n_participant": n,
+                        "stage": stage["name"],
+                        "status": status,
+                        "raw_size": raw_size,
+                        **usage,
+                        "participants_per_s": n / usage["wall_time"],
+                    }
+                )
+                print(
+                    f"[{status}] {stage['name']}: {usage['wall_time']:.1f} s, "
+                    f"{usage['peak_rss']:.0f} MiB"
+                )
+                if usage["returncode"] != 0:
+                    print(f"See {workspace}/logs/{stage['name']}.log")
+                    failed.add(stage["name"])
+        finally:
+            # Failed workspaces are kept for inspection
+            if not (keep or failed):
+                shutil.rmtree(workspace)
+
+    return pd.DataFrame(rows)
+
+
+def smoke_test(n=100, workers=None, work_dir=None, seed=0):
+    """
+    Run every stage once on a small synthetic dataset, so that a stage that cannot run on
+    the synthetic data fails the benchmark before any timed scale
+
+    Parameters:
+    n (int, optional): Number of ABCD participants. Default is 100
+    workers (int, optional): Number of worker processes per stage. Default is PRS_TLE_WORKERS
+    work_dir (str, optional): Parent directory of the workspace. Default is the system temp
+    seed (int, optional): Random seed of the synthetic data. Default is 0
+
+    Returns:
+    results (DataFrame): As returned by benchmark
+    """
+    print(f"Smoke run of every stage with {n} participants")
+    results = benchmark([n], workers=workers, work_dir=work_dir, seed=seed)
+    failed = results.loc[results["status"] == "fail", "stage"].to_list()
+    if failed:
+        n_skipped = int(np.sum(results["status"] == "skipped"))
+        raise RuntimeError(
+            f"Stages failed on synthetic data: {', '.join(failed)} "
+            f"({n_skipped} downstream stages skipped)"
+        )
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark the pipeline stages on synthetic data at several scales"
+    )
+    parser.add_argument("targets", nargs="*", help="stages to run (default: all)")
+    parser.add_argument(
+        "-s",
+        "--scales",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 50000],
+        help="numbers of ABCD participants",
+    )
+    parser.add_argument("-w", "--workers", type=int, help="worker processes per stage")
+    parser.add_argument("-d", "--work-dir", help="parent directory of the workspaces")
+    parser.add_argument("-k", "--keep", action="store_true", help="keep the workspaces")
+    parser.add_argument(
+        "--smoke",
+        type=int,
+        default=100,
+        help="participants of the smoke run of every stage (0 to skip)",
+    )
+    parser.add_argument(
+        "-o",
+        "--out-dir",
+        default=f"{pipeline.ROOT}/data/benchmarks",
+        help="report directory",
+    )
+    args = parser.parse_args()
+
+    if args.smoke > 0:
+        smoke_test(args.smoke, args.workers, args.work_dir)
+    results = benchmark(
+        args.scales, args.targets, args.workers, args.work_dir, args.keep
+    )
+    os.makedirs(args.out_dir, exist_ok=True)
+    file_path = f"{args.out_dir}/benchmark_{time.strftime('%Y%m%d-%H%M%S')}"
+    results.to_csv(f"{file_path}.csv", index=False)
+    with open(f"{file_path}.json", "w") as f:
+        json.dump(
+            {
+                "args": vars(args),
+                "python": sys.version,
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+                "results": results.to_dict(orient="records"),
+            },
+            f,
+            indent=2,
+        )
+    print(f"Report written to {file_path}.csv")
+    sys.exit(0 if (results["status"] == "done").all() else 1)
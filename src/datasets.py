@@ -1,10 +1,312 @@
+import csv
 import glob
+import hashlib
+import io
+import os
+import sys
 import pandas as pd
 import numpy as np
-from neuroCombat import neuroCombat
+import harmonization
+
+sys.path.append(f"{os.path.dirname(os.path.abspath(__file__))}/analyses")
+import utilities as util
+
+
+# Loaders
+def _csv_ranges(file_path, chunk_bytes, skip=0):
+    """
+    Split the data rows of a CSV file into byte ranges ending at line boundaries
+
+    Parameters:
+    file_path (str): The path to the CSV file
+    chunk_bytes (int): Approximate number of bytes per range
+    skip (int, optional): Number of leading data rows to leave out. Default is 0
+
+    Returns:
+    header (bytes): Header line
+    ranges (list of tuple): Start and end offsets of each range
+    """
+    size = os.path.getsize(file_path)
+    ranges = []
+    with open(file_path, "rb") as f:
+        header = f.readline()
+        # Skipped rows are only scanned for line ends, never parsed
+        for _ in range(skip):
+            f.readline()
+        start = f.tell()
+        while start < size:
+            f.seek(min(start + chunk_bytes, size))
+            f.readline()
+            end = min(f.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return header, ranges
+
+
+def _read_csv_range(file_path, start, end, columns, dtype):
+    """
+    Parse a byte range of a participant x feature CSV file
+
+    The participant column is split off each line, and the features are parsed with one
+    scalar dtype by np.loadtxt, whose cost does not grow with the number of columns as
+    per-column dtypes of pandas do. Ranges with missing (empty) fields go through pandas.
+
+    Parameters:
+    file_path (str): The path to the CSV file
+    start (int): Offset of the first byte
+    end (int): Offset past the last byte
+    columns (list of str): Column names, starting with the participant column
+    dtype (numpy.dtype): Data type of the features
+
+    Returns:
+    participants (array-like): Participant of each row
+    values (array-like): Features of each row
+    """
+    with open(file_path, "rb") as f:
+        f.seek(start)
+        buffer = f.read(end - start)
+    lines = [line.split(b",", 1) for line in buffer.splitlines() if line.strip()]
+    participants = np.array([line[0].strip(b'"').decode() for line in lines])
+    rows = [line[1] if len(line) > 1 else b"" for line in lines]
+    if not rows:
+        return participants, np.empty((0, len(columns) - 1), dtype=dtype)
+    try:
+        values = np.loadtxt(rows, delimiter=",", dtype=dtype, ndmin=2)
+    except ValueError:
+        values = pd.read_csv(
+            io.BytesIO(b"\n".join(rows)),
+            header=None,
+            dtype=dtype,
+            low_memory=False,
+            skip_blank_lines=False,
+        ).to_numpy(dtype=dtype)
+    values = values.reshape(len(rows), -1)
+    if values.shape[1] != len(columns) - 1:
+        raise ValueError(
+            f"Rows of {file_path} have {values.shape[1]} features, "
+            f"expected {len(columns) - 1}"
+        )
+    return participants, values
+
+
+@util.profiled()
+def read_csv_array(
+    file_path,
+    participants,
+    dtype=np.float32,
+    chunk_bytes=64 << 20,
+    workers=None,
+    out=None,
+    skip=0,
+):
+    """
+    Stream a participant x feature CSV file into a preallocated array
+
+    Row chunks are parsed in parallel and copied into place as they arrive, so the file is
+    never held as a DataFrame. Rows must follow the order of the given participants, after
+    any skipped rows.
+
+    Parameters:
+    file_path (str): The path to the CSV file, indexed by participant in its first column
+    participants (array-like): Expected participant of each row
+    dtype (numpy.dtype, optional): Data type of the features. Default is float32
+    chunk_bytes (int, optional): Approximate number of bytes per chunk. Default is 64 MiB
+    workers (int, optional): Number of worker processes. Default is PRS_TLE_WORKERS, or 1
+    out (array-like, optional): Preallocated (e.g. memory-mapped) participant x feature array
+    skip (int, optional): Number of leading data rows to leave out. Default is 0
+
+    Returns:
+    out (array-like): Participant x feature array
+    """
+    header, ranges = _csv_ranges(file_path, chunk_bytes, skip)
+    # pandas takes about a minute to build empty columns from a 64,984-vertex header
+    columns = next(csv.reader([header.decode()]))
+    participants = np.asarray(participants).astype(str)
+    if out is None:
+        out = np.empty((len(participants), len(columns) - 1), dtype=dtype)
+
+    workers = util.get_workers(workers)
+    row = 0
+    # Parse as many chunks as there are workers at a time to bound memory
+    for i in range(0, len(ranges), workers):
+        tasks = [(file_path, *r, columns, dtype) for r in ranges[i : i + workers]]
+        for ids, values in util.parallel_map(_read_csv_range, tasks, workers):
+            if row + len(ids) > len(participants) or np.any(
+                ids.astype(str) != participants[row : row + len(ids)]
+            ):
+                raise ValueError(
+                    f"Participants of {file_path} do not match the expected order "
+                    f"around row {skip + row}"
+                )
+            out[row : row + len(ids)] = values
+            row += len(ids)
+
+    if row != len(participants):
+        raise ValueError(
+            f"{file_path} has {row} participants, expected {len(participants)}"
+        )
+    return out
+
+
+# Connectomes
+def read_connectome(file_path, cache_dir="../data/cache/connectomes", dtype=np.float32):
+    """
+    Read a raw connectome through a binary cache keyed by the path, size and modification
+    time of the source file
+
+    The CSV file is parsed once and stored as .npy, so later runs skip the text parser.
+    Editing or replacing the source file changes its key and triggers a fresh parse.
+
+    Parameters:
+    file_path (str): Path to a headerless node x node CSV file
+    cache_dir (str, optional): Cache directory. Default is '../data/cache/connectomes'
+    dtype (numpy.dtype, optional): Data type of the cached matrix. Default is float32
+
+    Returns:
+    mtx (array-like): Connectivity matrix (node x node)
+    """
+    stat = os.stat(file_path)
+    key = hashlib.sha1(
+        f"{os.path.abspath(file_path)}:{stat.st_size}:{stat.st_mtime_ns}".encode()
+    ).hexdigest()
+    cache_path = f"{cache_dir}/{key}.npy"
+    if os.path.exists(cache_path):
+        return np.load(cache_path)
+
+    mtx = pd.read_csv(file_path, header=None, dtype=np.float64).to_numpy(dtype=dtype)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, mtx)
+    os.replace(tmp_path, cache_path)
+    return mtx
+
+
+def fisher_z(mtx):
+    """
+    Fisher z-transform a functional connectome in place, zeroing negative and infinite
+    values and mirroring the upper triangle
+
+    Parameters:
+    mtx (array-like): Correlation matrix (node x node)
+
+    Returns:
+    mtx (array-like): Transformed matrix
+    """
+    np.arctanh(mtx, out=mtx)
+    mtx[(mtx < 0) | np.isinf(mtx)] = 0
+    np.add(np.triu(mtx, 1), mtx.T, out=mtx)
+    return mtx
+
+
+def log_weights(mtx):
+    """
+    Log-transform a structural connectome in place after mirroring the upper triangle,
+    zeroing infinite values
+
+    Parameters:
+    mtx (array-like): Streamline count matrix (node x node)
+
+    Returns:
+    mtx (array-like): Transformed matrix
+    """
+    np.add(np.triu(mtx, 1), mtx.T, out=mtx)
+    np.log(mtx, out=mtx)
+    mtx[np.isinf(mtx)] = 0
+    return mtx
+
+
+def _connectome_moments(files, transform):
+    """
+    Stream connectome files into a running (Welford) mean and sum of squared deviations
+
+    Parameters:
+    files (list of str): Paths to headerless node x node CSV files, read through the cache
+    transform (callable): In-place transform applied to each matrix
+
+    Returns:
+    n (int): Number of connectomes
+    mean (array-like): Mean connectome
+    m2 (array-like): Sum of squared deviations from the mean
+    """
+    n, mean, m2 = 0, None, None
+    for f in files:
+        mtx = transform(read_connectome(f).astype(np.float64))
+        n += 1
+        if mean is None:
+            mean, m2 = np.zeros_like(mtx), np.zeros_like(mtx)
+        delta = mtx - mean
+        mean += delta / n
+        mtx -= mean
+        m2 += delta * mtx
+    return n, mean, m2
+
+
+def aggregate_connectomes(files, transform, workers=None):
+    """
+    Average connectomes without stacking them
+
+    Each worker streams its share of the files into a running mean and variance, and the
+    partial moments are then merged, so memory stays proportional to a single connectome
+    per worker however many files there are.
+
+    Parameters:
+    files (list of str): Paths to headerless node x node CSV files
+    transform (callable): Picklable in-place transform applied to each matrix
+    workers (int, optional): Number of worker processes. Default is PRS_TLE_WORKERS, or 1
+
+    Returns:
+    mean (array-like): Mean connectome
+    var (array-like): Variance across connectomes (ddof=1)
+    n (int): Number of connectomes
+    """
+    if len(files) == 0:
+        raise ValueError("No connectome files to aggregate")
+    workers = min(util.get_workers(workers), len(files))
+    tasks = [(list(part), transform) for part in np.array_split(files, workers)]
+
+    n, mean, m2 = 0, None, None
+    for n_b, mean_b, m2_b in util.parallel_map(_connectome_moments, tasks, workers):
+        if mean is None:
+            n, mean, m2 = n_b, mean_b, m2_b
+            continue
+        # Merge partial moments (Chan et al.)
+        delta = mean_b - mean
+        total = n + n_b
+        mean += delta * (n_b / total)
+        m2 += m2_b + delta**2 * (n * n_b / total)
+        n = total
+
+    var = m2 / (n - 1) if n > 1 else np.full_like(m2, np.nan)
+    return mean, var, n
+
+
+# Incremental updates
+def processed_participants(dir_path, participants):
+    """
+    Number of leading participants of a release that are already in a processed data store
+
+    Parameters:
+    dir_path (str): The path to the data store directory
+    participants (array-like): Participants of the release, in order
+
+    Returns:
+    n (int): Number of stored participants, or 0 if the store is missing or its
+        participants are not the first ones of the release
+    """
+    if not os.path.exists(f"{dir_path}/participant.npy"):
+        return 0
+    stored = util.load_data(dir_path, ["participant"])[0].astype(str)
+    participants = np.asarray(participants).astype(str)
+    if len(stored) > len(participants) or np.any(stored != participants[: len(stored)]):
+        return 0
+    return len(stored)
+
+
+def main(workers=None):
+    # Storage precision of the processed data
+    dtype = util.get_dtype()
 
-
-def main():
     print("--------------------")
     print("Loading ABCD dataset")
     print("--------------------")
@@ -30,75 +332,102 @@ def main():
     abcd_genetics = pd.read_csv(
         "../data/raw/abcd_genetics.csv", index_col="participant"
     )
-    pc10 = abcd_genetics.filter(like="PC")
-    prs_all = abcd_genetics.filter(like="Pt")
-    thresh = prs_all.columns.to_list()
+    thresh = abcd_genetics.filter(like="Pt").columns.to_list()
+
+    # Incremental updates only process the participants appended since the last run,
+    # harmonized with the stored ComBat estimates
+    store = "../data/processed/abcd_data"
+    n_processed = 0
+    if util.config("incremental") and os.path.exists(
+        "../data/processed/abcd_combat.pkl"
+    ):
+        n_processed = processed_participants(store, abcd_demographics.index)
+        abcd_combat = util.load_result(
+            "../data/processed/abcd_combat.pkl", ["estimates"]
+        )[0]
+        unseen = set(site.iloc[n_processed:]) - set(abcd_combat["levels"]["site"])
+        if n_processed and (
+            unseen or list(util.load_data(store, ["thresh"])[0]) != thresh
+        ):
+            print("New sites or PRS thresholds, processing all participants")
+            n_processed = 0
+    if n_processed:
+        print(
+            f"{n_processed} participants already processed, "
+            f"{len(abcd_demographics) - n_processed} new"
+        )
+    new = slice(n_processed, None)
+    pc10 = abcd_genetics.filter(like="PC").iloc[new]
+    prs_all = abcd_genetics.filter(like="Pt").iloc[new]
 
     print()
     print("Morphological data")
     print("--------------------")
     # Vertex-wise cortical thickness
-    abcd_ct = pd.read_csv("../data/raw/abcd_ct_vertex.csv", index_col="participant")
-    ct_vertex = np.transpose(abcd_ct.to_numpy())
-    covars = pd.DataFrame({"age": age, "sex": sex == "M", "site": site})
-    categorical_cols = ["sex"]
-    batch_col = "site"
-    ct_vertex = np.transpose(
-        neuroCombat(
-            dat=ct_vertex,
-            covars=covars,
-            batch_col=batch_col,
-            categorical_cols=categorical_cols,
-        )["data"]
+    ct_vertex = read_csv_array(
+        "../data/raw/abcd_ct_vertex.csv",
+        abcd_demographics.index[new],
+        workers=workers,
+        skip=n_processed,
     )
 
     # Parcellated corticla thickness
     abcd_ct = pd.read_csv("../data/raw/abcd_ct_aparc.csv", index_col="participant")
-    ct_aparc = np.transpose(abcd_ct.to_numpy())
-    covars = pd.DataFrame({"age": age, "sex": sex == "M", "site": site})
-    categorical_cols = ["sex"]
-    batch_col = "site"
-    ct_aparc = np.transpose(
-        neuroCombat(
-            dat=ct_aparc,
-            covars=covars,
-            batch_col=batch_col,
-            categorical_cols=categorical_cols,
-        )["data"]
-    )
+    ct_aparc = abcd_ct.to_numpy()[new]
 
     # Subcortical/intracranial volume
     abcd_sv = pd.read_csv("../data/raw/abcd_sv.csv", index_col="participant")
-    sv = np.transpose(abcd_sv.to_numpy())
-    covars = pd.DataFrame({"age": age, "sex": sex == "M", "site": site})
+    sv = abcd_sv.to_numpy()[new]
+
+    # Harmonize all morphological blocks with a shared site design
+    covars = pd.DataFrame({"age": age, "sex": sex == "M", "site": site}).iloc[new]
     categorical_cols = ["sex"]
     batch_col = "site"
-    sv = np.transpose(
-        neuroCombat(
-            dat=sv,
-            covars=covars,
-            batch_col=batch_col,
-            categorical_cols=categorical_cols,
-        )["data"]
+    blocks = {"ct_vertex": ct_vertex, "ct_aparc": ct_aparc, "sv": sv}
+    if n_processed:
+        with util.profiled("combat_apply"):
+            harmonized = harmonization.combat_apply(
+                blocks, covars, abcd_combat, dtype=dtype
+            )
+    else:
+        with util.profiled("combat_fit"):
+            harmonized, abcd_combat = harmonization.combat_fit(
+                blocks,
+                covars=covars,
+                batch_col=batch_col,
+                categorical_cols=categorical_cols,
+                dtype=dtype,
+            )
+    ct_vertex, ct_aparc, sv = (
+        harmonized["ct_vertex"],
+        harmonized["ct_aparc"],
+        harmonized["sv"],
     )
     icv, sv = sv[:, sv.shape[1] - 1], sv[:, : sv.shape[1] - 1]
 
     print()
     print("Save data")
     print("--------------------")
-    np.savez(
-        "../data/processed/abcd_data",
-        age=age,
-        sex=sex,
-        site=site,
-        pc10=pc10,
-        thresh=thresh,
-        prs_all=prs_all,
-        ct_vertex=ct_vertex,
-        ct_aparc=ct_aparc,
-        sv=sv,
-        icv=icv,
-    )
+    data = {
+        "age": age.iloc[new],
+        "sex": sex.iloc[new],
+        "site": site.iloc[new],
+        "pc10": pc10,
+        "prs_all": prs_all,
+        "ct_vertex": ct_vertex,
+        "ct_aparc": ct_aparc,
+        "sv": sv,
+        "icv": icv,
+        # Written last, so that the store only counts completely appended participants
+        "participant": abcd_demographics.index[new].astype(str),
+    }
+    if n_processed:
+        util.append_data(store, data, start=n_processed)
+    else:
+        util.save_data(store, {**data, "thresh": thresh})
+        util.save_to_pickle(
+            "../data/processed/abcd_combat.pkl", {"estimates": abcd_combat}
+        )
     print()
 
     print()
@@ -137,7 +466,7 @@ def main():
     print("Thickness data")
     print("-------------------------")
     local_tle_ct = pd.read_csv("../data/raw/local_tle_ct.csv", index_col="participant")
-    ct = np.transpose(local_tle_ct.to_numpy())
+    ct = local_tle_ct.to_numpy()
     covars = pd.DataFrame(
         {
             "age": age,
@@ -148,26 +477,28 @@ def main():
     )
     categorical_cols = ["sex", "group"]
     batch_col = "dataset"
-    ct = np.transpose(
-        neuroCombat(
-            dat=ct,
+    with util.profiled("combat_fit"):
+        ct = harmonization.combat_fit(
+            {"ct": ct},
             covars=covars,
             batch_col=batch_col,
             categorical_cols=categorical_cols,
-        )["data"]
-    )
+            dtype=dtype,
+        )[0]["ct"]
 
     print()
     print("Save data")
     print("-------------------------")
-    np.savez(
+    util.save_data(
         "../data/processed/local_tle_data",
-        age=age,
-        sex=sex,
-        dataset=dataset,
-        group=group,
-        focus=focus,
-        ct=ct,
+        {
+            "age": age,
+            "sex": sex,
+            "dataset": dataset,
+            "group": group,
+            "focus": focus,
+            "ct": ct,
+        },
     )
 
     print()
@@ -206,19 +537,21 @@ def main():
     print("Thickness data")
     print("-------------------------")
     multi_tle_ct = pd.read_csv("../data/raw/multi_tle_ct.csv", index_col="participant")
-    ct = multi_tle_ct.to_numpy()
+    ct = multi_tle_ct.to_numpy(dtype=dtype)
 
     print()
     print("Save data")
     print("-------------------------")
-    np.savez(
+    util.save_data(
         "../data/processed/multi_tle_data",
-        age=age,
-        sex=sex,
-        site=site,
-        group=group,
-        focus=focus,
-        ct=ct,
+        {
+            "age": age,
+            "sex": sex,
+            "site": site,
+            "group": group,
+            "focus": focus,
+            "ct": ct,
+        },
     )
 
     print()
@@ -254,18 +587,20 @@ def main():
     print("Thickness data")
     print("-------------------------")
     multi_ige_ct = pd.read_csv("../data/raw/multi_ige_ct.csv", index_col="participant")
-    ct = multi_ige_ct.to_numpy()
+    ct = multi_ige_ct.to_numpy(dtype=dtype)
 
     print()
     print("Save data")
     print("-------------------------")
-    np.savez(
+    util.save_data(
         "../data/processed/multi_ige_data",
-        age=age,
-        sex=sex,
-        site=site,
-        group=group,
-        ct=ct,
+        {
+            "age": age,
+            "sex": sex,
+            "site": site,
+            "group": group,
+            "ct": ct,
+        },
     )
 
     print()
@@ -276,67 +611,44 @@ def main():
     print()
     print("Functional connectomes")
     print("-----------------------")
-    # Load files
-    files = glob.glob("../data/raw/connectomes/*FC*")
-
     # Compute average connectome
-    for i, f in enumerate(files):
-        mtx = np.loadtxt(f, delimiter=",")
-        mtx_z = np.arctanh(mtx)
-        mtx_z[(mtx_z < 0) | np.isinf(mtx_z)] = 0
-        mtx_z = np.triu(mtx_z, 1) + mtx_z.T
-
-        if i == 0:
-            fc = np.empty((mtx_z.shape[0], mtx_z.shape[1], len(files)))
-
-        fc[:, :, i] = mtx_z
-
-    mean_fc = np.mean(fc, axis=2)
+    files = sorted(glob.glob("../data/raw/connectomes/*FC*"))
+    mean_fc, _, _ = aggregate_connectomes(files, fisher_z, workers=workers)
 
     # Isolate cortico-cortical and cortico-subcortical functional connectivity
     ctx_idx = np.concatenate(
         [np.arange(49, 52), np.arange(53, 84), np.arange(84, 87), np.arange(88, 119)]
     )
     sctx_idx = np.array([6, 5, 1, 4, 3, 2, 0, 13, 12, 8, 11, 10, 9, 7])
-    fc_ctx = mean_fc[np.ix_(ctx_idx, ctx_idx)]
-    fc_sctx = mean_fc[np.ix_(sctx_idx, ctx_idx)]
+    fc_ctx = mean_fc[np.ix_(ctx_idx, ctx_idx)].astype(dtype)
+    fc_sctx = mean_fc[np.ix_(sctx_idx, ctx_idx)].astype(dtype)
 
     print()
     print("Structural connectomes")
     print("-----------------------")
-    # Load files
-    files = glob.glob("../data/raw/connectomes/*SC*")
-
     # Compute average connectome
-    for i, f in enumerate(files):
-        mtx = np.loadtxt(f, delimiter=",")
-        mtx_log = np.log(np.triu(mtx, 1) + mtx.T)
-        mtx_log[np.isinf(mtx_log)] = 0
-
-        if i == 0:
-            sc = np.empty((mtx_log.shape[0], mtx_log.shape[1], len(files)))
-
-        sc[:, :, i] = mtx_log
-
-    mean_sc = np.mean(sc, axis=2)
+    files = sorted(glob.glob("../data/raw/connectomes/*SC*"))
+    mean_sc, _, _ = aggregate_connectomes(files, log_weights, workers=workers)
 
     # Isolate cortico-cortical and cortico-subcortical structural connectivity
     ctx_idx = np.concatenate(
         [np.arange(49, 52), np.arange(53, 84), np.arange(85, 88), np.arange(89, 120)]
     )
     sctx_idx = np.array([6, 5, 1, 4, 3, 2, 0, 13, 12, 8, 11, 10, 9, 7])
-    sc_ctx = mean_sc[np.ix_(ctx_idx, ctx_idx)]
-    sc_sctx = mean_sc[np.ix_(sctx_idx, ctx_idx)]
+    sc_ctx = mean_sc[np.ix_(ctx_idx, ctx_idx)].astype(dtype)
+    sc_sctx = mean_sc[np.ix_(sctx_idx, ctx_idx)].astype(dtype)
 
     print()
     print("Save data")
     print("-----------------------")
-    np.savez(
+    util.save_data(
         "../data/processed/hcp_data",
-        fc_ctx=fc_ctx,
-        fc_sctx=fc_sctx,
-        sc_ctx=sc_ctx,
-        sc_sctx=sc_sctx,
+        {
+            "fc_ctx": fc_ctx,
+            "fc_sctx": fc_sctx,
+            "sc_ctx": sc_ctx,
+            "sc_sctx": sc_sctx,
+        },
     )
 
 
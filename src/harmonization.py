@@ -0,0 +1,297 @@
+import numpy as np
+
+
+# Design
+def make_design(
+    covars, batch_col, categorical_cols=(), continuous_cols=(), levels=None
+):
+    """
+    Build the ComBat design matrix, laid out as in neuroCombat: full one-hot batch
+    indicators, one-hot categorical covariates without their first level, and continuous
+    covariates. Continuous covariates are kept in float64, whereas neuroCombat rounds them
+    to float32.
+
+    Parameters:
+    covars (DataFrame): Covariates of each participant, including the batch column
+    batch_col (str): Batch (site/scanner) column name
+    categorical_cols (list of str, optional): Categorical covariates to preserve
+    continuous_cols (list of str, optional): Continuous covariates to preserve
+    levels (dict, optional): Levels of the batch and categorical columns from a previous fit
+
+    Returns:
+    design (array-like): Design matrix (n_sample x n_design)
+    batch (array-like): Batch index of each participant
+    levels (dict): Levels of the batch and categorical columns
+    """
+    if levels is None:
+        levels = {
+            col: np.unique(np.asarray(covars[col], dtype=object))
+            for col in [batch_col, *categorical_cols]
+        }
+
+    columns = []
+    for col in [batch_col, *categorical_cols]:
+        values = np.asarray(covars[col], dtype=object)
+        unknown = set(values) - set(levels[col])
+        if unknown:
+            raise ValueError(f"Unknown {col} levels: {sorted(map(str, unknown))}")
+        onehot = (values[:, None] == levels[col][None, :]).astype(float)
+        columns.append(onehot if col == batch_col else onehot[:, 1:])
+        if col == batch_col:
+            batch = np.argmax(onehot, axis=1)
+    for col in continuous_cols:
+        columns.append(np.asarray(covars[col], dtype=float)[:, None])
+
+    return np.hstack(columns), batch, levels
+
+
+# Empirical Bayes
+def _aprior(delta_hat):
+    m, s2 = np.mean(delta_hat), np.var(delta_hat, ddof=1)
+    return (2 * s2 + m**2) / s2
+
+
+def _bprior(delta_hat):
+    m, s2 = np.mean(delta_hat), np.var(delta_hat, ddof=1)
+    return (m * s2 + m**3) / s2
+
+
+def _it_sol(s1, s2, n, g_hat, d_hat, g_bar, t2, a, b, conv=0.0001):
+    """
+    Iterate the parametric empirical Bayes posteriors of one batch on sufficient statistics
+
+    Equivalent to it_sol of neuroCombat, where sum((s - g)^2) is expanded from the sums
+    s1 = sum(s) and s2 = sum(s^2) so that no standardized data needs to be kept.
+
+    Returns:
+    g_new (array-like): Posterior location of each feature
+    d_new (array-like): Posterior scale of each feature
+    """
+    g_old, d_old = g_hat.copy(), d_hat.copy()
+    change = 1
+    while change > conv:
+        g_new = (t2 * n * g_hat + d_old * g_bar) / (t2 * n + d_old)
+        sum2 = s2 - 2 * g_new * s1 + n * g_new**2
+        d_new = (0.5 * sum2 + b) / (n / 2.0 + a - 1.0)
+        change = max(
+            (np.abs(g_new - g_old) / g_old).max(), (np.abs(d_new - d_old) / d_old).max()
+        )
+        g_old, d_old = g_new, d_new
+    return g_new, d_new
+
+
+# Harmonization
+def _standardize(x, design, mod_design, batch_weights, b_hat, var_pooled):
+    """
+    Standardize a chunk of features with fitted location and scale parameters
+
+    Returns:
+    s (array-like): Standardized data (n_sample x n_chunk)
+    mean (array-like): Grand mean plus covariate effects (n_sample x n_chunk)
+    """
+    grand_mean = batch_weights @ b_hat[: len(batch_weights)]
+    mean = grand_mean + mod_design @ b_hat
+    return (x - mean) / np.sqrt(var_pooled), mean
+
+
+def combat_fit(
+    blocks,
+    covars,
+    batch_col,
+    categorical_cols=(),
+    continuous_cols=(),
+    chunk_size=8192,
+    out=None,
+    dtype=None,
+):
+    """
+    Harmonize several feature blocks with parametric empirical Bayes ComBat, building the
+    design once and sharing it across blocks
+
+    Reproduces neuroCombat (eb=True, parametric=True, mean_only=False, no reference batch),
+    with features processed in chunks so that standardized copies of the full data are
+    never held in memory. Parameters are always estimated in float64; dtype only sets the
+    storage of the harmonized arrays.
+
+    Parameters:
+    blocks (dict): Participant x feature arrays to harmonize, keyed by name
+    covars (DataFrame): Covariates of each participant, including the batch column
+    batch_col (str): Batch (site/scanner) column name
+    categorical_cols (list of str, optional): Categorical covariates to preserve
+    continuous_cols (list of str, optional): Continuous covariates to preserve
+    chunk_size (int, optional): Number of features per chunk. Default is 8192
+    out (dict, optional): Preallocated output arrays keyed by block name (may be the inputs)
+    dtype (numpy.dtype, optional): Data type of the harmonized arrays. Default is float64
+
+    Returns:
+    harmonized (dict): Harmonized participant x feature arrays, keyed by name
+    estimates (dict): Design levels and fitted parameters of each block, see combat_apply
+    """
+    design, batch, levels = make_design(
+        covars, batch_col, categorical_cols, continuous_cols
+    )
+    n_sample = design.shape[0]
+    n_batch = len(levels[batch_col])
+    batch_idx = [np.flatnonzero(batch == i) for i in range(n_batch)]
+    batch_weights = np.array([len(idx) for idx in batch_idx]) / n_sample
+    mod_design = design.copy()
+    mod_design[:, :n_batch] = 0
+    # Shared least-squares operators of the design and of the batch indicators
+    design_pinv = np.linalg.inv(design.T @ design) @ design.T
+    batch_design = design[:, :n_batch]
+    batch_pinv = np.linalg.inv(batch_design.T @ batch_design) @ batch_design.T
+
+    estimates = {
+        "batch_col": batch_col,
+        "categorical_cols": list(categorical_cols),
+        "continuous_cols": list(continuous_cols),
+        "levels": levels,
+        "batch_weights": batch_weights,
+        "blocks": {},
+    }
+    harmonized = {}
+    for name, data in blocks.items():
+        n_feature = data.shape[1]
+        chunks = [
+            slice(start, min(start + chunk_size, n_feature))
+            for start in range(0, n_feature, chunk_size)
+        ]
+
+        # Location and pooled scale of each feature
+        b_hat = np.empty((design.shape[1], n_feature))
+        var_pooled = np.empty(n_feature)
+        for sl in chunks:
+            x = np.asarray(data[:, sl], dtype=float)
+            b_hat[:, sl] = design_pinv @ x
+            var_pooled[sl] = np.mean((x - design @ b_hat[:, sl]) ** 2, axis=0)
+        var_pooled[var_pooled == 0] = np.median(var_pooled != 0)
+
+        # Batch effects and per-batch sufficient statistics of the standardized data
+        gamma_hat = np.empty((n_batch, n_feature))
+        delta_hat = np.empty((n_batch, n_feature))
+        s1 = np.empty((n_batch, n_feature))
+        s2 = np.empty((n_batch, n_feature))
+        for sl in chunks:
+            s, _ = _standardize(
+                np.asarray(data[:, sl], dtype=float),
+                design,
+                mod_design,
+                batch_weights,
+                b_hat[:, sl],
+                var_pooled[sl],
+            )
+            gamma_hat[:, sl] = batch_pinv @ s
+            for i, idx in enumerate(batch_idx):
+                s1[i, sl] = np.sum(s[idx], axis=0)
+                s2[i, sl] = np.sum(s[idx] ** 2, axis=0)
+                delta_hat[i, sl] = np.var(s[idx], axis=0, ddof=1)
+        delta_hat[delta_hat == 0] = 1
+
+        # Empirical Bayes adjustments
+        gamma_bar = np.mean(gamma_hat, axis=1)
+        t2 = np.var(gamma_hat, axis=1, ddof=1)
+        gamma_star = np.empty_like(gamma_hat)
+        delta_star = np.empty_like(delta_hat)
+        for i, idx in enumerate(batch_idx):
+            gamma_star[i], delta_star[i] = _it_sol(
+                s1[i],
+                s2[i],
+                len(idx),
+                gamma_hat[i],
+                delta_hat[i],
+                gamma_bar[i],
+                t2[i],
+                _aprior(delta_hat[i]),
+                _bprior(delta_hat[i]),
+            )
+
+        estimates["blocks"][name] = {
+            "b_hat": b_hat,
+            "var_pooled": var_pooled,
+            "gamma_star": gamma_star,
+            "delta_star": delta_star,
+        }
+        harmonized[name] = _adjust(
+            data,
+            design,
+            mod_design,
+            batch,
+            estimates,
+            name,
+            chunks,
+            None if out is None else out[name],
+            dtype,
+        )
+
+    return harmonized, estimates
+
+
+def _adjust(data, design, mod_design, batch, estimates, name, chunks, out, dtype=None):
+    """
+    Remove fitted batch effects from a block, chunk by chunk
+
+    Returns:
+    out (array-like): Harmonized participant x feature array
+    """
+    block = estimates["blocks"][name]
+    if out is None:
+        out = np.empty(data.shape, dtype=np.float64 if dtype is None else dtype)
+    for sl in chunks:
+        s, mean = _standardize(
+            np.asarray(data[:, sl], dtype=float),
+            design,
+            mod_design,
+            estimates["batch_weights"],
+            block["b_hat"][:, sl],
+            block["var_pooled"][sl],
+        )
+        s = (s - block["gamma_star"][batch, sl]) / np.sqrt(
+            block["delta_star"][batch, sl]
+        )
+        out[:, sl] = s * np.sqrt(block["var_pooled"][sl]) + mean
+    return out
+
+
+def combat_apply(blocks, covars, estimates, chunk_size=8192, out=None, dtype=None):
+    """
+    Harmonize new participants with previously fitted ComBat parameters, without refitting
+
+    Parameters:
+    blocks (dict): Participant x feature arrays to harmonize, keyed by name
+    covars (DataFrame): Covariates of each participant, with batches seen during the fit
+    estimates (dict): Estimates returned by combat_fit
+    chunk_size (int, optional): Number of features per chunk. Default is 8192
+    out (dict, optional): Preallocated output arrays keyed by block name (may be the inputs)
+    dtype (numpy.dtype, optional): Data type of the harmonized arrays. Default is float64
+
+    Returns:
+    harmonized (dict): Harmonized participant x feature arrays, keyed by name
+    """
+    design, batch, _ = make_design(
+        covars,
+        estimates["batch_col"],
+        estimates["categorical_cols"],
+        estimates["continuous_cols"],
+        estimates["levels"],
+    )
+    mod_design = design.copy()
+    mod_design[:, : len(estimates["batch_weights"])] = 0
+
+    harmonized = {}
+    for name, data in blocks.items():
+        chunks = [
+            slice(start, min(start + chunk_size, data.shape[1]))
+            for start in range(0, data.shape[1], chunk_size)
+        ]
+        harmonized[name] = _adjust(
+            data,
+            design,
+            mod_design,
+            batch,
+            estimates,
+            name,
+            chunks,
+            None if out is None else out[name],
+            dtype,
+        )
+    return harmonized
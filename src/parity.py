@@ -0,0 +1,753 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from brainstat.stats.SLM import SLM
+from brainstat.stats.terms import FixedEffect
+from enigmatoolbox.permutation_testing import spin_test
+from neuroCombat import neuroCombat
+from scipy import linalg
+import harmonization
+
+sys.path.append(f"{os.path.dirname(os.path.abspath(__file__))}/analyses")
+import utilities as util
+
+
+# Helpers
+@contextlib.contextmanager
+def _settings(**values):
+    """
+    Temporarily set pipeline settings, unsetting those given as None
+
+    Parameters:
+    **values: Setting values keyed by name (e.g. spin_alpha=0.05)
+    """
+    names = {name: f"PRS_TLE_{name.upper()}" for name in values}
+    saved = {key: os.environ.get(key) for key in names.values()}
+    try:
+        for name, value in values.items():
+            if value is None:
+                os.environ.pop(names[name], None)
+            else:
+                os.environ[names[name]] = str(value)
+        yield
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+
+def _timed(func, *args, **kwargs):
+    """
+    Call a function and measure its wall time
+
+    Returns:
+    result (any): Result of the call
+    wall_time (float): Wall time in seconds
+    """
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def _compare(quantity, reference, optimized, tolerance):
+    """
+    Compare an optimized output with its reference
+
+    Parameters:
+    quantity (str): Name of the compared output
+    reference (array-like): Reference output
+    optimized (array-like): Optimized output
+    tolerance (float): Largest accepted absolute difference
+
+    Returns:
+    row (dict): Quantity, largest absolute difference, tolerance and outcome
+    """
+    reference = np.asarray(reference, dtype=float)
+    optimized = np.asarray(optimized, dtype=float)
+    if reference.shape != optimized.shape:
+        raise ValueError(
+            f"{quantity}: shapes differ ({reference.shape} vs {optimized.shape})"
+        )
+    diff = float(np.max(np.abs(reference - optimized), initial=0))
+    return {
+        "quantity": quantity,
+        "max_abs_diff": diff,
+        "tolerance": tolerance,
+        "passed": bool(diff <= tolerance),
+    }
+
+
+def _contrast_design(design, contrast):
+    """
+    Reparametrize a design so that a contrast becomes the coefficient of one column
+
+    The nuisance spans the design directions orthogonal to the contrast coefficients, and
+    the effect column carries the contrast, so that nuisance + effect spans the same space
+    and the t-value of the effect equals the t-value of the contrast.
+
+    Parameters:
+    design (array-like): Design matrix, possibly rank deficient (n_sample x n_column)
+    contrast (array-like): Contrast over participants, as passed to brainstat SLM
+
+    Returns:
+    nuisance (array-like): Nuisance design (n_sample x n_column - 1)
+    effect (array-like): Effect column (n_sample)
+    """
+    design = np.asarray(design, dtype=float)
+    c = np.linalg.pinv(design) @ np.asarray(contrast, dtype=float)
+    return design @ linalg.null_space(c[None, :]), design @ c / (c @ c)
+
+
+def _regional_data(rng, n_sample, n_feature=68):
+    """
+    Simulate participant covariates and regional thickness with covariate effects
+
+    Returns:
+    age (array-like): Age of each participant
+    sex (array-like): Sex of each participant ('M' or 'F')
+    data (array-like): Participant x feature data
+    """
+    age = rng.uniform(9, 11, n_sample)
+    sex = rng.choice(["M", "F"], n_sample)
+    data = (
+        2.5
+        + 0.1 * np.outer(age - 10, rng.normal(-1, 0.5, n_feature))
+        + 0.05 * np.outer(sex == "M", rng.normal(1, 1, n_feature))
+        + 0.15 * rng.standard_normal((n_sample, n_feature))
+    )
+    return age, sex, data
+
+
+# Checks
+def check_combat(n_sample=1000, n_feature=2000, n_site=10, seed=0, **kwargs):
+    """
+    Shared-design ComBat (harmonization.combat_fit) against neuroCombat
+
+    Returns:
+    rows (list of dict): Comparisons and timings
+    """
+    rng = np.random.default_rng(seed)
+    age, sex, data = _regional_data(rng, n_sample, n_feature)
+    # neuroCombat rounds continuous covariates to float32, so ages are made exact in it
+    age = age.astype(np.float32).astype(float)
+    site = rng.integers(n_site, size=n_sample)
+    data += rng.normal(0, 0.1, (n_site, n_feature))[site]
+    data *= rng.uniform(0.8, 1.2, (n_site, 1))[site]
+    covars = pd.DataFrame({"age": age, "sex": sex == "M", "site": site})
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        reference, t_ref = _timed(
+            neuroCombat,
+            dat=data.T,
+            covars=covars,
+            batch_col="site",
+            categorical_cols=["sex"],
+            continuous_cols=["age"],
+        )
+    (harmonized, estimates), t_opt = _timed(
+        harmonization.combat_fit,
+        {"data": data},
+        covars=covars,
+        batch_col="site",
+        categorical_cols=["sex"],
+        continuous_cols=["age"],
+    )
+    applied = harmonization.combat_apply({"data": data}, covars, estimates)
+
+    return _rows(
+        "combat",
+        t_ref,
+        t_opt,
+        [
+            _compare("harmonized", reference["data"].T, harmonized["data"], 1e-8),
+            _compare(
+                "gamma_star",
+                reference["estimates"]["gamma.star"],
+                estimates["blocks"]["data"]["gamma_star"],
+                1e-8,
+            ),
+            _compare(
+                "delta_star",
+                reference["estimates"]["delta.star"],
+                estimates["blocks"]["data"]["delta_star"],
+                1e-8,
+            ),
+            _compare("apply_vs_fit", harmonized["data"], applied["data"], 1e-10),
+        ],
+    )
+
+
+def check_glm(n_sample=2000, n_threshold=10, seed=0, **kwargs):
+    """
+    Mass-univariate GLM over all PRS thresholds against one brainstat SLM per threshold
+
+    Returns:
+    rows (list of dict): Comparisons and timings
+    """
+    rng = np.random.default_rng(seed)
+    age, sex, data = _regional_data(rng, n_sample)
+    pc10 = rng.normal(0, 0.01, (n_sample, 10))
+    prs_all = rng.standard_normal((n_sample, n_threshold))
+    data += 0.02 * prs_all[:, [0]] * rng.standard_normal(data.shape[1])
+    model = (
+        FixedEffect(age, "Age")
+        + FixedEffect(sex, "Sex")
+        + FixedEffect(pc10, [f"PC{i}" for i in range(10)])
+    )
+
+    def reference():
+        slms = []
+        for i in range(n_threshold):
+            prs = prs_all[:, i]
+            slm = SLM(
+                model + FixedEffect(prs, "PRS"), prs, correction="fdr", two_tailed=True
+            )
+            slm.fit(data)
+            slms.append(slm)
+        return slms
+
+    slms, t_ref = _timed(reference)
+    glms, t_opt = _timed(util.mass_univariate_glm, data, model.m, prs_all)
+
+    return _rows(
+        "glm",
+        t_ref,
+        t_opt,
+        [
+            _compare("t", [s.t for s in slms], [g.t for g in glms], 1e-8),
+            _compare("Q", [s.Q for s in slms], [g.Q for g in glms], 1e-8),
+        ],
+    )
+
+
+def check_incremental(n_sample=2000, n_new=200, n_threshold=10, seed=0, **kwargs):
+    """
+    GLM updated with appended participants from stored sufficient statistics against a
+    refit on the whole cohort
+
+    Returns:
+    rows (list of dict): Comparisons and timings
+    """
+    rng = np.random.default_rng(seed)
+    age, sex, data = _regional_data(rng, n_sample)
+    pc10 = rng.normal(0, 0.01, (n_sample, 10))
+    prs_all = rng.standard_normal((n_sample, n_threshold))
+    data += 0.02 * prs_all[:, [0]] * rng.standard_normal(data.shape[1])
+    model = (
+        FixedEffect(age, "Age")
+        + FixedEffect(sex, "Sex")
+        + FixedEffect(pc10, [f"PC{i}" for i in range(10)])
+    )
+    n_old = n_sample - n_new
+
+    glms, t_ref = _timed(util.mass_univariate_glm, data, model.m, prs_all)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = f"{tmp_dir}/statistics.pkl"
+        # The previous release, fitted with its own design
+        old = slice(0, n_old)
+        old_model = (
+            FixedEffect(age[old], "Age")
+            + FixedEffect(sex[old], "Sex")
+            + FixedEffect(pc10[old], [f"PC{i}" for i in range(10)])
+        )
+        util.accumulate_glm(file_path, data[old], old_model.m, prs_all[old])
+        with _settings(incremental=1):
+            updates, t_opt = _timed(
+                util.accumulate_glm, file_path, data, model.m, prs_all
+            )
+
+    return _rows(
+        "incremental",
+        t_ref,
+        t_opt,
+        [
+            _compare("t", [g.t for g in glms], [u.t for u in updates], 1e-8),
+            _compare("Q", [g.Q for g in glms], [u.Q for u in updates], 1e-8),
+        ],
+    )
+
+
+def check_casecontrol(n_sample=600, seed=0, **kwargs):
+    """
+    Case-control contrasts as mass-univariate GLMs against utilities.casecontrol_difference
+
+    Returns:
+    rows (list of dict): Comparisons and timings
+    """
+    rng = np.random.default_rng(seed)
+    age, sex, data = _regional_data(rng, n_sample)
+    focus = rng.choice(["C", "L", "R"], n_sample, p=[0.4, 0.35, 0.25])
+    data -= 0.1 * (focus != "C")[:, None] * rng.uniform(0, 1, data.shape[1])
+    x = util.zscore_flip(data, focus, "C", "_")
+    covar = pd.DataFrame({"age": age, "sex": sex})
+
+    def reference():
+        return [
+            util.casecontrol_difference(x, covar, focus, "C", hemi)
+            for hemi in ["L", "R"]
+        ]
+
+    def optimized():
+        model = FixedEffect(focus)
+        for c in covar.keys():
+            model += FixedEffect(covar[c])
+        glms = []
+        for hemi in ["L", "R"]:
+            contrast = (focus == hemi).astype(int) - (focus == "C").astype(int)
+            nuisance, effect = _contrast_design(model.m, contrast)
+            glms.extend(util.mass_univariate_glm(x, nuisance, effect))
+        return glms
+
+    slms, t_ref = _timed(reference)
+    glms, t_opt = _timed(optimized)
+
+    return _rows(
+        "casecontrol",
+        t_ref,
+        t_opt,
+        [
+            _compare("t", [s.t for s in slms], [g.t for g in glms], 1e-8),
+            _compare("Q", [s.Q for s in slms], [g.Q for g in glms], 1e-8),
+        ],
+    )
+
+
+def check_residualize(n_sample=2000, n_feature=20000, seed=0, **kwargs):
+    """
+    Chunked projection (utilities.residualize) against the residuals of a brainstat SLM
+
+    Returns:
+    rows (list of dict): Comparisons and timings
+    """
+    rng = np.random.default_rng(seed)
+    age, sex, data = _regional_data(rng, n_sample, n_feature)
+    pc10 = rng.normal(0, 0.01, (n_sample, 10))
+    model = (
+        FixedEffect(age, "Age")
+        + FixedEffect(sex, "Sex")
+        + FixedEffect(pc10, [f"PC{i}" for i in range(10)])
+    )
+
+    def reference():
+        slm = SLM(model, np.ones(n_sample))
+        slm.fit(data)
+        return data - np.dot(slm.X, slm.coef)
+
+    residual_ref, t_ref = _timed(reference)
+    residual, t_opt = _timed(util.residualize, data, model.m)
+
+    return _rows(
+        "residualize",
+        t_ref,
+        t_opt,
+        [_compare("residual", residual_ref, residual, 1e-8)],
+    )
+
+
+def check_vertexwise(n_sample=2000, n_feature=64984, seed=0, **kwargs):
+    """
+    Out-of-core vertex-wise GLM on a memory-mapped store against one brainstat SLM
+
+    Returns:
+    rows (list of dict): Comparisons and timings
+    """
+    rng = np.random.default_rng(seed)
+    age, sex, data = _regional_data(rng, n_sample, n_feature)
+    pc10 = rng.normal(0, 0.01, (n_sample, 10))
+    prs = rng.standard_normal(n_sample)
+    data += 0.02 * prs[:, None] * rng.standard_normal(n_feature)
+    model = (
+        FixedEffect(age, "Age")
+        + FixedEffect(sex, "Sex")
+        + FixedEffect(pc10, [f"PC{i}" for i in range(10)])
+    )
+
+    def reference():
+        slm = SLM(
+            model + FixedEffect(prs, "PRS"), prs, correction="fdr", two_tailed=True
+        )
+        slm.fit(data)
+        return slm
+
+    slm, t_ref = _timed(reference)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        util.save_data(f"{tmp_dir}/store", {"ct_vertex": data.astype(np.float32)})
+        ct_vertex = util.load_data(f"{tmp_dir}/store", ["ct_vertex"])[0]
+        vertex, t_opt = _timed(
+            util.vertexwise_glm, ct_vertex, model.m, prs, f"{tmp_dir}/maps"
+        )
+        # The store holds float32 thickness, as datasets.py writes it
+        glm = util.mass_univariate_glm(ct_vertex, model.m, prs)[0]
+        comparisons = [
+            _compare("t", slm.t[0], vertex.t, 1e-3),
+            _compare("t_same_input", glm.t[0], vertex.t, 1e-8),
+            _compare("Q_same_input", glm.Q, vertex.Q, 1e-8),
+        ]
+
+    return _rows("vertexwise", t_ref, t_opt, comparisons)
+
+
+def _spin_maps(rng, n_map=1, n_region=68, r=0.3):
+    """
+    Simulate a target map and maps correlated with it
+
+    Returns:
+    target (array-like): Target map (n_region)
+    maps (array-like): Maps with a population correlation of r to the target (n_map x n_region)
+    """
+    target = rng.standard_normal(n_region)
+    noise = rng.standard_normal((n_map, n_region))
+    return target, r * target + np.sqrt(1 - r**2) * noise
+
+
+def check_rotations(n_rot=1000, seed=0, **kwargs):
+    """
+    Rotations intercepted from the installed ENIGMA toolbox (utilities.generate_rotations)
+    against the null distribution of its own spin_test with the same seed
+
+    Returns:
+    rows (list of dict): Comparisons and timings
+    """
+    map1, map2 = _spin_maps(np.random.default_rng(seed))
+    map2 = map2[0]
+    rotations, t_opt = _timed(util.generate_rotations, "fsa5", "aparc", n_rot, seed)
+
+    def reference():
+        np.random.seed(seed)
+        return spin_test(
+            map1,
+            map2,
+            surface_name="fsa5",
+            parcellation_name="aparc",
+            n_rot=n_rot,
+            null_dist=True,
+        )[1]
+
+    # Run after the interception, so that spin_test must also have been restored
+    null_ref, t_ref = _timed(reference)
+    null = [np.corrcoef(map1[idx], map2)[0, 1] for idx in rotations]
+
+    return _rows(
+        "rotations",
+        t_ref,
+        t_opt,
+        [_compare("null_xy", np.ravel(null_ref)[:n_rot], null, 1e-10)],
+    )
+
+
+def check_spin(n_rot=1000, seed=0, **kwargs):
+    """
+    Batched spin engine (utilities.spatial_correlation) against the ENIGMA spin_test, on
+    the same rotations
+
+    Returns:
+    rows (list of dict): Comparisons and timings
+    """
+    map1, map2 = _spin_maps(np.random.default_rng(seed))
+    map2 = map2[0]
+    util.load_rotations("fsa5", "aparc", n_rot, seed)
+    util.spatial_correlation.cache_clear()
+
+    def reference():
+        # Seeding as generate_rotations does reproduces the cached rotations
+        np.random.seed(seed)
+        p, null = spin_test(
+            map1,
+            map2,
+            surface_name="fsa5",
+            parcellation_name="aparc",
+            n_rot=n_rot,
+            null_dist=True,
+        )
+        return np.corrcoef(map1, map2)[0, 1], p, null
+
+    (r_ref, p_ref, null_ref), t_ref = _timed(reference)
+    (r, p, null), t_opt = _timed(
+        util.spatial_correlation, map1, map2, n_rot=n_rot, seed=seed
+    )
+
+    return _rows(
+        "spin",
+        t_ref,
+        t_opt,
+        [
+            _compare("r", r_ref, r, 1e-12),
+            _compare("p", p_ref, p, 1e-12),
+            _compare("null", np.ravel(null_ref), np.ravel(null), 1e-10),
+        ],
+    )
+
+
+def check_epicenter(n_rot=1000, seed=0, **kwargs):
+    """
+    Batched epicenter_mapping against the original loop of one spin_test per seed region,
+    each seeded like the cached rotations
+
+    Returns:
+    rows (list of dict): Comparisons and timings
+    """
+    rng = np.random.default_rng(seed)
+    target, _ = _spin_maps(rng)
+    connectome = np.abs(rng.standard_normal((68, 68)))
+    connectome = (connectome + connectome.T) / 2
+    util.load_rotations("fsa5", "aparc", n_rot, seed)
+    util.epicenter_mapping.cache_clear()
+
+    def reference():
+        epi_r, epi_p = [], []
+        for row in connectome:
+            np.random.seed(seed)
+            p, _ = spin_test(
+                row,
+                target,
+                surface_name="fsa5",
+                parcellation_name="aparc",
+                n_rot=n_rot,
+                null_dist=True,
+            )
+            epi_r.append(np.corrcoef(row, target)[0, 1])
+            epi_p.append(p)
+        return np.array(epi_r), np.array(epi_p)
+
+    (r_ref, p_ref), t_ref = _timed(reference)
+    with _settings(spin_alpha=None):
+        (r, p), t_opt = _timed(
+            util.epicenter_mapping, target, connectome, n_rot=n_rot, seed=seed
+        )
+
+    return _rows(
+        "epicenter",
+        t_ref,
+        t_opt,
+        [_compare("r", r_ref, r, 1e-12), _compare("p", p_ref, p, 1e-12)],
+    )
+
+
+def check_sequential_spin(n_rot=1000, seed=0, n_map=40, alpha=0.05, **kwargs):
+    """
+    Sequential spin tests (PRS_TLE_SPIN_ALPHA) against spin tests using every rotation
+
+    Decisions at alpha must agree, and p-values may differ by at most four Monte-Carlo
+    standard errors of the sequential estimate.
+
+    Returns:
+    rows (list of dict): Comparisons and timings
+    """
+    target, maps = _spin_maps(np.random.default_rng(seed), n_map, r=0.2)
+    util.load_rotations("fsa5", "aparc", n_rot, seed)
+    util.spatial_correlation_matrix.cache_clear()
+
+    with _settings(spin_alpha=None):
+        (r_ref, p_ref), t_ref = _timed(
+            util.spatial_correlation_matrix, maps, target[None], n_rot=n_rot, seed=seed
+        )
+    with _settings(spin_alpha=alpha):
+        (r, p, info), t_opt = _timed(
+            util.spatial_correlation_matrix,
+            maps,
+            target[None],
+            n_rot=n_rot,
+            seed=seed,
+            return_info=True,
+        )
+    # The error of p = 0 is bounded by the resolution of the rotations used
+    z = np.abs(p - p_ref) / np.maximum(info["mc_error"], 1 / (2 * info["n_rot"]))
+
+    return _rows(
+        "sequential_spin",
+        t_ref,
+        t_opt,
+        [
+            _compare("r", r_ref, r, 1e-12),
+            _compare("decision", p_ref < alpha, p < alpha, 0),
+            _compare("p_in_mc_errors", np.zeros_like(z), z, 4),
+            {
+                "quantity": "fraction_of_rotations_used",
+                "max_abs_diff": float(np.mean(info["n_rot"]) / n_rot),
+                "tolerance": np.nan,
+                "passed": True,
+            },
+        ],
+    )
+
+
+def check_precision(n_rot=1000, seed=0, n_sample=2000, n_feature=20000, **kwargs):
+    """
+    Numerical impact of PRS_TLE_PRECISION=float32 on harmonized storage, residualization,
+    spin tests and epicentre mapping, against the float64 paths
+
+    Spin p-values may differ where a null correlation ties the empirical one within float32
+    rounding, by at most one exceedance in each direction.
+
+    Returns:
+    rows (list of dict): Comparisons and timings
+    """
+    rng = np.random.default_rng(seed)
+    age, sex, data = _regional_data(rng, n_sample, n_feature)
+    site = rng.integers(10, size=n_sample)
+    data += rng.normal(0, 0.1, (10, n_feature))[site]
+    covars = pd.DataFrame({"age": age, "sex": sex == "M", "site": site})
+    model = FixedEffect(age, "Age") + FixedEffect(sex, "Sex")
+    target, maps = _spin_maps(rng, 40)
+    connectome = np.abs(rng.standard_normal((68, 68)))
+    connectome = (connectome + connectome.T) / 2
+    util.load_rotations("fsa5", "aparc", n_rot, seed)
+
+    def run(precision):
+        outputs, times = [], []
+        with _settings(precision=precision, spin_alpha=None):
+            for func, args, kwargs in [
+                (
+                    harmonization.combat_fit,
+                    ({"data": data}, covars, "site", ["sex"]),
+                    {"dtype": util.get_dtype()},
+                ),
+                (util.residualize, (data, model.m), {}),
+                (
+                    util.spatial_correlation_matrix,
+                    (maps, target[None]),
+                    {"n_rot": n_rot, "seed": seed, "return_null": True},
+                ),
+                (
+                    util.epicenter_mapping,
+                    (target, connectome),
+                    {"n_rot": n_rot, "seed": seed},
+                ),
+            ]:
+                result, wall_time = _timed(func, *args, **kwargs)
+                outputs.append(result)
+                times.append(wall_time)
+        return outputs, times
+
+    (combat_ref, residual_ref, spin_ref, epi_ref), t_ref = run("float64")
+    (combat, residual, spin, epi), t_opt = run("float32")
+    p_tolerance = 1 / n_rot
+
+    # Timings are reported per component
+    return (
+        _rows(
+            "precision",
+            t_ref[0],
+            t_opt[0],
+            [_compare("harmonized", combat_ref[0]["data"], combat[0]["data"], 1e-5)],
+        )
+        + _rows(
+            "precision",
+            t_ref[1],
+            t_opt[1],
+            [_compare("residual", residual_ref, residual, 1e-5)],
+        )
+        + _rows(
+            "precision",
+            t_ref[2],
+            t_opt[2],
+            [
+                _compare("spin_r", spin_ref[0], spin[0], 1e-12),
+                _compare("spin_p", spin_ref[1], spin[1], p_tolerance),
+                _compare("spin_null", spin_ref[2], spin[2], 1e-5),
+            ],
+        )
+        + _rows(
+            "precision",
+            t_ref[3],
+            t_opt[3],
+            [
+                _compare("epicenter_r", epi_ref[0], epi[0], 1e-12),
+                _compare("epicenter_p", epi_ref[1], epi[1], p_tolerance),
+            ],
+        )
+    )
+
+
+def _rows(check, reference_time, optimized_time, comparisons):
+    """
+    Attach the check name and timings to its comparisons
+
+    Returns:
+    rows (list of dict): One row per comparison
+    """
+    return [
+        {
+            "check": check,
+            **comparison,
+            "reference_time": reference_time,
+            "optimized_time": optimized_time,
+            "speedup": reference_time / optimized_time,
+        }
+        for comparison in comparisons
+    ]
+
+
+CHECKS = {
+    "combat": check_combat,
+    "glm": check_glm,
+    "incremental": check_incremental,
+    "casecontrol": check_casecontrol,
+    "residualize": check_residualize,
+    "vertexwise": check_vertexwise,
+    "rotations": check_rotations,
+    "spin": check_spin,
+    "epicenter": check_epicenter,
+    "sequential_spin": check_sequential_spin,
+    "precision": check_precision,
+}
+
+
+def run(checks=(), **kwargs):
+    """
+    Run parity checks of the optimized engines against their reference code paths on
+    synthetic inputs with fixed seeds
+
+    The memo layer is kept in memory only, so that optimized paths are always computed.
+
+    Parameters:
+    checks (list of str, optional): Checks to run. Default is all checks
+    **kwargs: Options passed to every check (e.g. n_rot, seed)
+
+    Returns:
+    results (DataFrame): Difference, tolerance, outcome and timings of each comparison
+    """
+    unknown = set(checks) - set(CHECKS)
+    if unknown:
+        raise ValueError(f"Unknown checks: {', '.join(sorted(unknown))}")
+
+    rows = []
+    with _settings(memo_dir=None):
+        for name in checks or CHECKS:
+            rows.extend(CHECKS[name](**kwargs))
+    return pd.DataFrame(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the optimized engines with their reference code paths"
+    )
+    parser.add_argument("checks", nargs="*", help="checks to run (default: all)")
+    parser.add_argument("-r", "--n-rot", type=int, default=1000, help="spin rotations")
+    parser.add_argument("-s", "--seed", type=int, default=0, help="random seed")
+    parser.add_argument("-o", "--out-dir", help="report directory")
+    args = parser.parse_args()
+
+    results = run(args.checks, n_rot=args.n_rot, seed=args.seed)
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(results.to_string(index=False))
+    if args.out_dir:
+        os.makedirs(args.out_dir, exist_ok=True)
+        file_path = f"{args.out_dir}/parity_{time.strftime('%Y%m%d-%H%M%S')}"
+        results.to_csv(f"{file_path}.csv", index=False)
+        with open(f"{file_path}.json", "w") as f:
+            json.dump(
+                {"args": vars(args), "results": results.to_dict(orient="records")},
+                f,
+                indent=2,
+            )
+    sys.exit(0 if results["passed"].all() else 1)
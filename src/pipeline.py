@@ -0,0 +1,437 @@
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+ROOT = os.path.abspath(f"{os.path.dirname(os.path.abspath(__file__))}/..")
+STATE_FILE = f"{ROOT}/data/pipeline_state.json"
+
+# Settings that change how a stage runs but not what it produces
+IGNORED_SETTINGS = [
+    "PRS_TLE_WORKERS",
+    "PRS_TLE_MEMO_DIR",
+    "PRS_TLE_MEMO_SIZE",
+    "PRS_TLE_PROFILE",
+    "PRS_TLE_INCREMENTAL",
+]
+
+RAW = "data/raw"
+PROCESSED = "data/processed"
+RESULTS = "data/results"
+UTILITIES = "src/analyses/utilities.py"
+
+STAGES = [
+    {
+        "name": "datasets",
+        "script": "src/datasets.py",
+        "code": [UTILITIES, "src/harmonization.py"],
+        "inputs": [
+            f"{RAW}/abcd_demographics.csv",
+            f"{RAW}/abcd_genetics.csv",
+            f"{RAW}/abcd_ct_vertex.csv",
+            f"{RAW}/abcd_ct_aparc.csv",
+            f"{RAW}/abcd_sv.csv",
+            f"{RAW}/local_tle_demographics.csv",
+            f"{RAW}/local_tle_ct.csv",
+            f"{RAW}/multi_tle_demographics.csv",
+            f"{RAW}/multi_tle_ct.csv",
+            f"{RAW}/multi_ige_demographics.csv",
+            f"{RAW}/multi_ige_ct.csv",
+            f"{RAW}/connectomes",
+        ],
+        "outputs": [
+            f"{PROCESSED}/abcd_data",
+            f"{PROCESSED}/abcd_combat.pkl",
+            f"{PROCESSED}/local_tle_data",
+            f"{PROCESSED}/multi_tle_data",
+            f"{PROCESSED}/multi_ige_data",
+            f"{PROCESSED}/hcp_data",
+        ],
+    },
+    {
+        "name": "01_geneticCorrelation",
+        "script": "src/analyses/01_geneticCorrelation.py",
+        "code": [UTILITIES],
+        "inputs": [f"{PROCESSED}/abcd_data"],
+        "outputs": [
+            f"{RESULTS}/01_geneticCorrelation/global_association.pkl",
+            f"{RESULTS}/01_geneticCorrelation/regional_association.pkl",
+            f"{RESULTS}/01_geneticCorrelation/regional_statistics.pkl",
+        ],
+    },
+    {
+        "name": "02_epicentreMapping",
+        "script": "src/analyses/02_epicentreMapping.py",
+        "code": [UTILITIES],
+        "inputs": [
+            f"{PROCESSED}/hcp_data",
+            f"{RESULTS}/01_geneticCorrelation/regional_association.pkl",
+        ],
+        "outputs": [f"{RESULTS}/02_epicentreMapping/epicentre.pkl"],
+    },
+    {
+        "name": "03_atrophyAssociation",
+        "script": "src/analyses/03_atrophyAssociation.py",
+        "code": [UTILITIES],
+        "inputs": [
+            f"{PROCESSED}/local_tle_data",
+            f"{PROCESSED}/multi_tle_data",
+            f"{RESULTS}/01_geneticCorrelation/regional_association.pkl",
+        ],
+        "outputs": [
+            f"{RESULTS}/03_atrophyAssociation/local_atrophy.pkl",
+            f"{RESULTS}/03_atrophyAssociation/local_association.pkl",
+            f"{RESULTS}/03_atrophyAssociation/local_association_nulls.npz",
+            f"{RESULTS}/03_atrophyAssociation/multi_atrophy.pkl",
+            f"{RESULTS}/03_atrophyAssociation/multi_association.pkl",
+            f"{RESULTS}/03_atrophyAssociation/multi_association_nulls.npz",
+        ],
+    },
+    {
+        "name": "04_epicentreAssociation",
+        "script": "src/analyses/04_epicentreAssociation.py",
+        "code": [UTILITIES],
+        "inputs": [
+            f"{PROCESSED}/hcp_data",
+            f"{RESULTS}/02_epicentreMapping/epicentre.pkl",
+            f"{RESULTS}/03_atrophyAssociation/multi_atrophy.pkl",
+        ],
+        "outputs": [
+            f"{RESULTS}/04_epicentreAssociation/multi_epicentre.pkl",
+            f"{RESULTS}/04_epicentreAssociation/multi_association.pkl",
+            f"{RESULTS}/04_epicentreAssociation/multi_association_nulls.npz",
+        ],
+    },
+    {
+        "name": "s01_subcorticalCorrelation",
+        "script": "src/analyses/s01_subcorticalCorrelation.py",
+        "code": [UTILITIES],
+        "inputs": [f"{PROCESSED}/abcd_data"],
+        "outputs": [f"{RESULTS}/s01_subcorticalCorrelation/global_association.pkl"],
+    },
+    {
+        "name": "s02_igeSpecificity",
+        "script": "src/analyses/s02_igeSpecificity.py",
+        "code": [UTILITIES],
+        "inputs": [
+            f"{PROCESSED}/multi_ige_data",
+            f"{PROCESSED}/hcp_data",
+            f"{RESULTS}/01_geneticCorrelation/regional_association.pkl",
+            f"{RESULTS}/02_epicentreMapping/epicentre.pkl",
+        ],
+        "outputs": [
+            f"{RESULTS}/s02_igeSpecificity/ige_atrophy.pkl",
+            f"{RESULTS}/s02_igeSpecificity/ige_atrophyAssociation.pkl",
+            f"{RESULTS}/s02_igeSpecificity/ige_atrophyAssociation_nulls.npz",
+            f"{RESULTS}/s02_igeSpecificity/ige_epicentre.pkl",
+            f"{RESULTS}/s02_igeSpecificity/ige_epicentreAssociation.pkl",
+            f"{RESULTS}/s02_igeSpecificity/ige_epicentreAssociation_nulls.npz",
+        ],
+    },
+    {
+        "name": "s03_psychiatryAtrophySpecificity",
+        "script": "src/analyses/s03_psychiatryAtrophySpecificity.py",
+        "code": [UTILITIES],
+        "inputs": [f"{RESULTS}/01_geneticCorrelation/regional_association.pkl"],
+        "outputs": [
+            f"{RESULTS}/s03_psychiatryAtrophySpecificity/psychiatric_atrophy.pkl",
+            f"{RESULTS}/s03_psychiatryAtrophySpecificity/psychiatric_association.pkl",
+            f"{RESULTS}/s03_psychiatryAtrophySpecificity/psychiatric_association_nulls.npz",
+        ],
+    },
+    {
+        "name": "s04_psychiatryEpicentreSpecificity",
+        "script": "src/analyses/s04_psychiatryEpicentreSpecificity.py",
+        "code": [UTILITIES],
+        "inputs": [
+            f"{PROCESSED}/hcp_data",
+            f"{RESULTS}/02_epicentreMapping/epicentre.pkl",
+            f"{RESULTS}/s03_psychiatryAtrophySpecificity/psychiatric_atrophy.pkl",
+        ],
+        "outputs": [
+            f"{RESULTS}/s04_psychiatryEpicentreSpecificity/psychiatric_epicentre.pkl",
+            f"{RESULTS}/s04_psychiatryEpicentreSpecificity/psychiatric_association.pkl",
+            f"{RESULTS}/s04_psychiatryEpicentreSpecificity/psychiatric_association_nulls.npz",
+        ],
+    },
+    {
+        "name": "s05_thresholdConsistency",
+        "script": "src/analyses/s05_thresholdConsistency.py",
+        "code": [UTILITIES],
+        "inputs": [
+            f"{PROCESSED}/abcd_data",
+            f"{RESULTS}/03_atrophyAssociation/multi_atrophy.pkl",
+            f"{RESULTS}/s02_igeSpecificity/ige_atrophy.pkl",
+        ],
+        "outputs": [
+            f"{RESULTS}/s05_thresholdConsistency/threshold_global_association.pkl",
+            f"{RESULTS}/s05_thresholdConsistency/threshold_regional_association.pkl",
+            f"{RESULTS}/s05_thresholdConsistency/threshold_regional_statistics.pkl",
+            f"{RESULTS}/s05_thresholdConsistency/threshold_similarity.pkl",
+            f"{RESULTS}/s05_thresholdConsistency/threshold_atrophy_similarity.pkl",
+        ],
+    },
+    {
+        "name": "s06_epicentreConsistency",
+        "script": "src/analyses/s06_epicentreConsistency.py",
+        "code": [UTILITIES],
+        "inputs": [
+            f"{PROCESSED}/hcp_data",
+            f"{RESULTS}/s05_thresholdConsistency/threshold_regional_association.pkl",
+        ],
+        "outputs": [f"{RESULTS}/s06_epicentreConsistency/percent_epicentre.pkl"],
+    },
+]
+
+
+# Fingerprints
+def file_fingerprint(path, known=None):
+    """
+    Content fingerprint of a file or directory
+
+    Members of .npz archives are fingerprinted through their CRCs, which ignores the zip
+    timestamps np.savez writes. Content hashes are reused while size and mtime match.
+
+    Parameters:
+    path (str): Path relative to the repository root
+    known (dict, optional): Previously computed fingerprints keyed by path, updated in place
+
+    Returns:
+    fingerprint (str): Hex digest, or None if the path does not exist
+    """
+    full_path = f"{ROOT}/{path}"
+    if not os.path.exists(full_path):
+        return None
+    if os.path.isdir(full_path):
+        h = hashlib.sha1()
+        for name in sorted(os.listdir(full_path)):
+            h.update(name.encode())
+            h.update(str(file_fingerprint(f"{path}/{name}", known)).encode())
+        return h.hexdigest()
+
+    stat = os.stat(full_path)
+    known = {} if known is None else known
+    entry = known.get(path)
+    if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+        return entry["hash"]
+
+    h = hashlib.sha1()
+    if full_path.endswith(".npz") and zipfile.is_zipfile(full_path):
+        with zipfile.ZipFile(full_path) as archive:
+            for info in sorted(archive.infolist(), key=lambda i: i.filename):
+                h.update(f"{info.filename}:{info.CRC}:{info.file_size}".encode())
+    else:
+        with open(full_path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+    known[path] = {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "hash": h.hexdigest(),
+    }
+    return known[path]["hash"]
+
+
+def stage_fingerprint(stage, known):
+    """
+    Fingerprint of everything a stage depends on: code, inputs and settings
+
+    Parameters:
+    stage (dict): Stage declaration
+    known (dict): Previously computed file fingerprints, updated in place
+
+    Returns:
+    fingerprint (str): Hex digest
+    """
+    h = hashlib.sha1()
+    for path in [stage["script"]] + stage["code"] + stage["inputs"]:
+        h.update(f"{path}={file_fingerprint(path, known)}".encode())
+    for key in sorted(os.environ):
+        if key.startswith("PRS_TLE_") and key not in IGNORED_SETTINGS:
+            h.update(f"{key}={os.environ[key]}".encode())
+    return h.hexdigest()
+
+
+# DAG
+def build_dag(stages):
+    """
+    Derive stage dependencies from the declared inputs and outputs
+
+    Parameters:
+    stages (list of dict): Stage declarations
+
+    Returns:
+    upstream (dict): Names of the stages each stage depends on
+    """
+    producer = {}
+    for stage in stages:
+        for output in stage["outputs"]:
+            if output in producer:
+                raise ValueError(
+                    f"{output} is produced by {producer[output]} and {stage['name']}"
+                )
+            producer[output] = stage["name"]
+
+    upstream = {
+        stage["name"]: {producer[i] for i in stage["inputs"] if i in producer}
+        for stage in stages
+    }
+
+    # Reject cycles
+    visited, active = set(), set()
+
+    def visit(name):
+        if name in active:
+            raise ValueError(f"Dependency cycle through {name}")
+        if name not in visited:
+            active.add(name)
+            for dep in upstream[name]:
+                visit(dep)
+            active.remove(name)
+            visited.add(name)
+
+    for name in upstream:
+        visit(name)
+
+    return upstream
+
+
+def select_stages(upstream, targets):
+    """
+    Select the targets and every stage they depend on
+
+    Parameters:
+    upstream (dict): Names of the stages each stage depends on
+    targets (list of str): Requested stages, or all stages if empty
+
+    Returns:
+    selected (set): Names of the selected stages
+    """
+    unknown = set(targets) - set(upstream)
+    if unknown:
+        raise ValueError(f"Unknown stages: {', '.join(sorted(unknown))}")
+
+    selected = set()
+    todo = list(targets) if targets else list(upstream)
+    while todo:
+        name = todo.pop()
+        if name not in selected:
+            selected.add(name)
+            todo.extend(upstream[name])
+    return selected
+
+
+# Runner
+def run_stage(stage):
+    """
+    Run the script of a stage from its own directory
+
+    Parameters:
+    stage (dict): Stage declaration
+    """
+    for output in stage["outputs"]:
+        os.makedirs(os.path.dirname(f"{ROOT}/{output}"), exist_ok=True)
+    script = f"{ROOT}/{stage['script']}"
+    result = subprocess.run(
+        [sys.executable, os.path.basename(script)], cwd=os.path.dirname(script)
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"{stage['name']} failed with exit code {result.returncode}")
+
+
+def run(targets=(), jobs=1, force=False, dry_run=False):
+    """
+    Run the stages whose code, inputs or settings changed since their last successful run,
+    running independent branches concurrently
+
+    Parameters:
+    targets (list of str, optional): Stages to bring up to date. Default is all stages
+    jobs (int, optional): Number of stages running at the same time. Default is 1
+    force (bool, optional): Rerun the selected stages regardless. Default is False
+    dry_run (bool, optional): Only report which stages would run. Default is False
+    """
+    stages = {stage["name"]: stage for stage in STAGES}
+    upstream = build_dag(STAGES)
+    selected = select_stages(upstream, targets)
+
+    state = {"stages": {}, "files": {}}
+    if os.path.exists(STATE_FILE):
+        with open(STATE_FILE) as f:
+            state = json.load(f)
+
+    def save_state():
+        os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
+        with open(STATE_FILE, "w") as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+
+    # Fingerprints depend on upstream outputs, so stages are checked once their
+    # dependencies have finished
+    pending = {name: upstream[name] & selected for name in selected}
+    finished, stale, failed = set(), set(), []
+    with ThreadPoolExecutor(max(1, jobs)) as executor:
+        running = {}
+        while pending or running:
+            for name in sorted(n for n in pending if pending[n] <= finished):
+                del pending[name]
+                stage = stages[name]
+                fingerprint = stage_fingerprint(stage, state["files"])
+                outdated = (
+                    force
+                    or upstream[name] & stale
+                    or state["stages"].get(name) != fingerprint
+                    or any(not os.path.exists(f"{ROOT}/{o}") for o in stage["outputs"])
+                )
+                if not outdated:
+                    print(f"[skip] {name}")
+                    finished.add(name)
+                elif dry_run:
+                    print(f"[stale] {name}")
+                    stale.add(name)
+                    finished.add(name)
+                else:
+                    print(f"[run] {name}")
+                    running[executor.submit(run_stage, stage)] = name
+
+            if not running:
+                if pending:
+                    continue
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    future.result()
+                except RuntimeError as e:
+                    failed.append(str(e))
+                    continue
+                # Outputs were rewritten, so their fingerprints are recomputed downstream
+                for output in stages[name]["outputs"]:
+                    state["files"].pop(output, None)
+                state["stages"][name] = stage_fingerprint(stages[name], state["files"])
+                save_state()
+                finished.add(name)
+                print(f"[done] {name}")
+
+            if failed:
+                # Do not start stages downstream of a failure
+                pending.clear()
+
+    save_state()
+    if failed:
+        raise RuntimeError("; ".join(failed))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Incrementally run the dataset and analysis stages"
+    )
+    parser.add_argument("targets", nargs="*", help="stages to run (default: all)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="concurrent stages")
+    parser.add_argument("-f", "--force", action="store_true", help="rerun all targets")
+    parser.add_argument("-n", "--dry-run", action="store_true", help="only list stages")
+    args = parser.parse_args()
+    run(args.targets, args.jobs, args.force, args.dry_run)
@@ -0,0 +1,426 @@
+import argparse
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+sys.path.append(f"{os.path.dirname(os.path.abspath(__file__))}/analyses")
+import utilities as util
+
+# Desikan-Killiany regions, in ENIGMA order
+REGIONS = [
+    "bankssts",
+    "caudalanteriorcingulate",
+    "caudalmiddlefrontal",
+    "cuneus",
+    "entorhinal",
+    "fusiform",
+    "inferiorparietal",
+    "inferiortemporal",
+    "isthmuscingulate",
+    "lateraloccipital",
+    "lateralorbitofrontal",
+    "lingual",
+    "medialorbitofrontal",
+    "middletemporal",
+    "parahippocampal",
+    "paracentral",
+    "parsopercularis",
+    "parsorbitalis",
+    "parstriangularis",
+    "pericalcarine",
+    "postcentral",
+    "posteriorcingulate",
+    "precentral",
+    "precuneus",
+    "rostralanteriorcingulate",
+    "rostralmiddlefrontal",
+    "superiorfrontal",
+    "superiorparietal",
+    "superiortemporal",
+    "supramarginal",
+    "frontalpole",
+    "temporalpole",
+    "transversetemporal",
+    "insula",
+]
+
+# Subcortical structures and their typical volumes (mm3), in ENIGMA order
+SUBCORTICAL = {
+    "accumb": 500,
+    "amyg": 1500,
+    "caud": 3500,
+    "hippo": 4000,
+    "pal": 1800,
+    "put": 5000,
+    "thal": 7500,
+}
+
+# PRSice threshold columns: those the analyses select, plus the genome-wide significant
+# and all-SNP scores that they have to skip
+THRESHOLDS = sorted(
+    {"Pt_5e-08", "Pt_1", *util.PRS_THRESHOLDS}, key=lambda col: float(col[3:])
+)
+
+# Number of vertices of the conte69 surface (both hemispheres)
+N_VERTEX = 64984
+
+
+# Participants
+def _demographics(rng, prefix, n, n_site, age_range, site_col="site"):
+    """
+    Draw participant identifiers, age, sex and site
+
+    Parameters:
+    rng (numpy.random.Generator): Random generator
+    prefix (str): Prefix of the participant identifiers
+    n (int): Number of participants
+    n_site (int): Number of sites (or datasets)
+    age_range (tuple of float): Minimum and maximum age
+    site_col (str, optional): Name of the site column. Default is 'site'
+
+    Returns:
+    demographics (DataFrame): Age, sex and site, indexed by participant
+    """
+    # Balanced sites, as ComBat needs two participants per site to estimate its scale
+    sites = rng.permutation(np.arange(n) % n_site)
+    return pd.DataFrame(
+        {
+            "age": rng.uniform(*age_range, size=n).round(2),
+            "sex": rng.choice(["M", "F"], size=n),
+            site_col: [f"{site_col}{s + 1:02d}" for s in sites],
+        },
+        index=pd.Index([f"{prefix}{i:08d}" for i in range(n)], name="participant"),
+    )
+
+
+def _fixed_point(values, decimals):
+    """
+    Format values in [0, 10) as fixed-point CSV rows through a lookup table, which is
+    much faster than formatting each float
+
+    Parameters:
+    values (array-like): Participant x feature array, clipped to [0, 10)
+    decimals (int): Number of decimals
+
+    Returns:
+    rows (array-like): Bytes of each row, ending with a newline (n_participant x n_byte)
+    """
+    scale = 10**decimals
+    width = decimals + 2
+    table = np.array(
+        [f"{c / scale:.{decimals}f}" for c in range(10 * scale)], dtype=f"S{width}"
+    )
+    codes = np.clip(np.rint(values * scale), 0, 10 * scale - 1).astype(np.intp)
+    rows = np.empty((*values.shape, width + 1), dtype=np.uint8)
+    rows[..., :width] = table.view(np.uint8).reshape(-1, width)[codes]
+    rows[..., width] = ord(",")
+    rows[:, -1, width] = ord("\n")
+    return rows.reshape(len(values), -1)
+
+
+def _write_features(
+    file_path,
+    demographics,
+    site_col,
+    signal,
+    columns,
+    mean,
+    sd,
+    rng,
+    decimals=None,
+    block_size=1000,
+):
+    """
+    Write a participant x feature CSV file block by block, simulating features as a
+    feature mean plus age, sex, site and signal effects and noise
+
+    Parameters:
+    file_path (str): The path to the CSV file
+    demographics (DataFrame): Age, sex and site of each participant
+    site_col (str): Name of the site column
+    signal (array-like): Score of each participant multiplying a random effect map
+    columns (list of str): Feature names
+    mean (float or array-like): Mean of each feature
+    sd (float or array-like): Standard deviation of each feature
+    rng (numpy.random.Generator): Random generator
+    decimals (int, optional): Write features in [0, 10) with this many decimals through a
+        fast fixed-point path. Default is None (general float formatting)
+    block_size (int, optional): Number of participants per block. Default is 1000
+    """
+    n_feature = len(columns)
+    mean = np.broadcast_to(np.asarray(mean, dtype=float), n_feature)
+    sd = np.broadcast_to(np.asarray(sd, dtype=float), n_feature)
+    sites, site = np.unique(demographics[site_col], return_inverse=True)
+    # Effect maps, in units of the feature standard deviation
+    age_map = rng.normal(-0.1, 0.05, n_feature)
+    sex_map = rng.normal(0.1, 0.1, n_feature)
+    site_map = rng.normal(0, 0.3, (len(sites), n_feature))
+    signal_map = rng.normal(0, 0.2, n_feature)
+
+    age = demographics["age"].to_numpy()
+    age = (age - age.mean()) / (age.std() or 1)
+    male = (demographics["sex"] == "M").to_numpy()
+    with open(file_path, "wb") as f:
+        f.write((",".join(["participant", *columns]) + "\n").encode())
+        for start in range(0, len(demographics), block_size):
+            sl = slice(start, start + block_size)
+            z = (
+                age[sl, None] * age_map
+                + male[sl, None] * sex_map
+                + site_map[site[sl]]
+                + signal[sl, None] * signal_map
+                + rng.standard_normal((len(age[sl]), n_feature), dtype=np.float32)
+            )
+            values = mean + sd * z
+            if decimals is None:
+                block = pd.DataFrame(values, index=demographics.index[sl])
+                f.write(block.to_csv(header=False, float_format="%.4g").encode())
+                continue
+            for participant, row in zip(
+                demographics.index[sl], _fixed_point(values, decimals)
+            ):
+                f.write(f"{participant},".encode())
+                f.write(row.tobytes())
+
+
+# Datasets
+def write_abcd(out_dir, n_participant, n_site=21, n_vertex=N_VERTEX, rng=None):
+    """
+    Write synthetic ABCD demographics, polygenic scores and morphology
+
+    Parameters:
+    out_dir (str): Raw data directory
+    n_participant (int): Number of participants
+    n_site (int, optional): Number of sites. Default is 21
+    n_vertex (int, optional): Number of surface vertices. Default is 64984 (conte69)
+    rng (numpy.random.Generator, optional): Random generator
+    """
+    rng = np.random.default_rng(rng)
+    demographics = _demographics(rng, "NDAR_INV", n_participant, n_site, (9, 11))
+    demographics.to_csv(f"{out_dir}/abcd_demographics.csv")
+
+    # Polygenic scores at nested thresholds are strongly correlated
+    pcs = rng.normal(0, 0.01, (n_participant, 10))
+    liability = rng.standard_normal(n_participant)
+    weights = np.linspace(0.5, 0.95, len(THRESHOLDS))
+    prs = liability[:, None] * weights + rng.standard_normal(
+        (n_participant, len(THRESHOLDS))
+    ) * np.sqrt(1 - weights**2)
+    genetics = pd.DataFrame(
+        np.hstack([pcs, prs * 1e-4]),
+        index=demographics.index,
+        columns=[f"PC{i + 1}" for i in range(10)] + THRESHOLDS,
+    )
+    genetics.to_csv(f"{out_dir}/abcd_genetics.csv", float_format="%.6g")
+
+    _write_features(
+        f"{out_dir}/abcd_ct_vertex.csv",
+        demographics,
+        "site",
+        liability,
+        [f"V{i}" for i in range(n_vertex)],
+        2.5,
+        0.4,
+        rng,
+        decimals=3,
+    )
+    _write_features(
+        f"{out_dir}/abcd_ct_aparc.csv",
+        demographics,
+        "site",
+        liability,
+        [f"{h}_{r}_thickavg" for h in "LR" for r in REGIONS],
+        2.7,
+        0.15,
+        rng,
+        decimals=3,
+    )
+    _write_features(
+        f"{out_dir}/abcd_sv.csv",
+        demographics,
+        "site",
+        liability,
+        [f"{h}{s}" for h in "LR" for s in SUBCORTICAL] + ["ICV"],
+        [*SUBCORTICAL.values(), *SUBCORTICAL.values(), 1.5e6],
+        [
+            *(0.1 * v for v in SUBCORTICAL.values()),
+            *(0.1 * v for v in SUBCORTICAL.values()),
+            1.5e5,
+        ],
+        rng,
+    )
+
+
+def write_tle(out_dir, name, n_participant, n_site, site_col="site", rng=None):
+    """
+    Write synthetic TLE case-control demographics and regional thickness
+
+    Parameters:
+    out_dir (str): Raw data directory
+    name (str): Dataset name, either 'local' or 'multi'
+    n_participant (int): Number of participants
+    n_site (int): Number of sites (or datasets)
+    site_col (str, optional): Name of the site column. Default is 'site'
+    rng (numpy.random.Generator, optional): Random generator
+    """
+    rng = np.random.default_rng(rng)
+    demographics = _demographics(
+        rng, f"{name}_", n_participant, n_site, (18, 60), site_col
+    )
+    demographics["focus"] = rng.choice(
+        ["C", "L", "R"], n_participant, p=[0.4, 0.35, 0.25]
+    )
+    demographics["group"] = np.where(demographics["focus"] == "C", "HC", "TLE")
+    demographics.to_csv(f"{out_dir}/{name}_tle_demographics.csv")
+
+    _write_features(
+        f"{out_dir}/{name}_tle_ct.csv",
+        demographics,
+        site_col,
+        -(demographics["group"] == "TLE").to_numpy(dtype=float),
+        [f"{h}_{r}_thickavg" for h in "LR" for r in REGIONS],
+        2.5,
+        0.15,
+        rng,
+        decimals=3,
+    )
+
+
+def write_ige(out_dir, n_participant, n_site, rng=None):
+    """
+    Write synthetic IGE case-control demographics and regional thickness
+
+    Parameters:
+    out_dir (str): Raw data directory
+    n_participant (int): Number of participants
+    n_site (int): Number of sites
+    rng (numpy.random.Generator, optional): Random generator
+    """
+    rng = np.random.default_rng(rng)
+    demographics = _demographics(rng, "multi_", n_participant, n_site, (18, 60))
+    demographics["group"] = rng.choice(["HC", "IGE"], n_participant, p=[0.55, 0.45])
+    demographics.to_csv(f"{out_dir}/multi_ige_demographics.csv")
+
+    _write_features(
+        f"{out_dir}/multi_ige_ct.csv",
+        demographics,
+        "site",
+        -(demographics["group"] == "IGE").to_numpy(dtype=float),
+        [f"{h}_{r}_thickavg" for h in "LR" for r in REGIONS],
+        2.5,
+        0.15,
+        rng,
+        decimals=3,
+    )
+
+
+def write_connectomes(out_dir, n_subject, n_node=120, n_timepoint=200, rng=None):
+    """
+    Write synthetic HCP-style connectomes as headerless, upper triangular node x node CSV
+    files: functional connectivity as correlations of random time series sharing a
+    latent signal, and structural connectivity as sparse streamline counts
+
+    Parameters:
+    out_dir (str): Raw data directory
+    n_subject (int): Number of subjects
+    n_node (int, optional): Number of nodes (at least 120). Default is 120
+    n_timepoint (int, optional): Number of time points per series. Default is 200
+    rng (numpy.random.Generator, optional): Random generator
+    """
+    if n_node < 120:
+        raise ValueError("Connectomes need at least 120 nodes")
+    rng = np.random.default_rng(rng)
+    os.makedirs(f"{out_dir}/connectomes", exist_ok=True)
+    loadings = rng.normal(0, 1, (n_node, 5))
+    distance = np.abs(np.subtract.outer(np.arange(n_node), np.arange(n_node)))
+    for i in range(n_subject):
+        subject = f"{100000 + i}"
+        latent = rng.standard_normal((n_timepoint, 5))
+        ts = latent @ loadings.T + 2 * rng.standard_normal((n_timepoint, n_node))
+        fc = np.triu(np.corrcoef(ts, rowvar=False))
+        np.savetxt(
+            f"{out_dir}/connectomes/{subject}_FC.csv", fc, fmt="%.6f", delimiter=","
+        )
+
+        sc = rng.poisson(200 * np.exp(-distance / 10) * rng.random((n_node, n_node)))
+        sc[rng.random((n_node, n_node)) < 0.5] = 0
+        np.savetxt(
+            f"{out_dir}/connectomes/{subject}_SC.csv",
+            np.triu(sc, 1),
+            fmt="%d",
+            delimiter=",",
+        )
+
+
+def generate(
+    out_dir,
+    n_abcd=1000,
+    n_abcd_site=21,
+    n_local_tle=100,
+    n_multi_tle=1000,
+    n_ige=500,
+    n_site=20,
+    n_connectome=20,
+    n_vertex=N_VERTEX,
+    n_node=120,
+    seed=0,
+):
+    """
+    Write a complete synthetic raw dataset, with the files and formats read by datasets.py
+
+    Parameters:
+    out_dir (str): Raw data directory
+    n_abcd (int, optional): Number of ABCD participants. Default is 1000
+    n_abcd_site (int, optional): Number of ABCD sites. Default is 21
+    n_local_tle (int, optional): Number of local TLE participants. Default is 100
+    n_multi_tle (int, optional): Number of multisite TLE participants. Default is 1000
+    n_ige (int, optional): Number of multisite IGE participants. Default is 500
+    n_site (int, optional): Number of multisite TLE and IGE sites. Default is 20
+    n_connectome (int, optional): Number of HCP subjects. Default is 20
+    n_vertex (int, optional): Number of surface vertices. Default is 64984 (conte69)
+    n_node (int, optional): Number of connectome nodes. Default is 120
+    seed (int, optional): Random seed. Default is 0
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    rngs = np.random.default_rng(seed).spawn(5)
+    write_abcd(out_dir, n_abcd, n_abcd_site, n_vertex, rngs[0])
+    write_tle(out_dir, "local", n_local_tle, 2, "dataset", rngs[1])
+    write_tle(out_dir, "multi", n_multi_tle, n_site, "site", rngs[2])
+    write_ige(out_dir, n_ige, n_site, rngs[3])
+    write_connectomes(out_dir, n_connectome, n_node, rng=rngs[4])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Write a synthetic raw dataset with realistic shapes"
+    )
+    parser.add_argument("out_dir", help="raw data directory to write")
+    parser.add_argument("--n-abcd", type=int, default=1000, help="ABCD participants")
+    parser.add_argument("--n-abcd-site", type=int, default=21, help="ABCD sites")
+    parser.add_argument(
+        "--n-local-tle", type=int, default=100, help="local TLE participants"
+    )
+    parser.add_argument(
+        "--n-multi-tle", type=int, default=1000, help="multisite TLE participants"
+    )
+    parser.add_argument(
+        "--n-ige", type=int, default=500, help="multisite IGE participants"
+    )
+    parser.add_argument(
+        "--n-site", type=int, default=20, help="multisite TLE/IGE sites"
+    )
+    parser.add_argument("--n-connectome", type=int, default=20, help="HCP subjects")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+    generate(
+        args.out_dir,
+        args.n_abcd,
+        args.n_abcd_site,
+        args.n_local_tle,
+        args.n_multi_tle,
+        args.n_ige,
+        args.n_site,
+        args.n_connectome,
+        seed=args.seed,
+    )